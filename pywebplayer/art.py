@@ -0,0 +1,184 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+import subprocess
+from config import ComponentBase, config
+
+__all__ = ["AlbumArtCache"]
+
+
+class AlbumArtCache(ComponentBase):
+    """Cache of album art, looked up once per album. The art is taken
+    from an image file beside the media files, or from the picture
+    embedded in the media file. Images are stored once per distinct
+    content, named by their SHA-1 hash, along with thumbnails in each
+    of THUMBNAIL_SIZES. Albums without any art are remembered for
+    RETRY_INTERVAL seconds.
+    """
+
+    # Widths in pixels of the thumbnails generated for each image
+    THUMBNAIL_SIZES = '64,300'
+    # Seconds before looking again for the art of an album which had none
+    RETRY_INTERVAL = 24 * 3600
+    # Image files checked for in the album directory, in order of preference
+    FOLDER_IMAGES = 'cover.jpg,folder.jpg,front.jpg,albumart.jpg,cover.png,folder.png,front.png'
+
+    __SCHEMA = """\
+create table if not exists album_art (
+  album_key text primary key,
+  hash text, -- null if the album has no art
+  checked real not null -- time the album was last checked in seconds
+);
+"""
+
+    # Leading bytes of the embedded picture formats, and their extensions
+    __IMAGE_SIGNATURES = (
+        ('\xff\xd8\xff', 'jpg'),
+        ('\x89PNG', 'png'),
+        ('GIF8', 'gif'),
+        ('BM', 'bmp'),
+    )
+
+    def __init__(self, art_dir=config.ART_DIR, index_file=config.ART_INDEX):
+        super(AlbumArtCache, self).__init__()
+        self._load_config()
+        self.art_dir = art_dir
+        if not os.path.isdir(art_dir):
+            os.makedirs(art_dir)
+        self.sizes = [int(size) for size in self.THUMBNAIL_SIZES.split(',')]
+        self._lock = threading.Lock()
+        self._album_locks = {}  # Held while the art of an album is extracted
+        self.conn = sqlite3.connect(index_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.executescript(self.__SCHEMA)
+
+    def get(self, path, artist, album):
+        """Returns the hash of the art for the album of the media file at
+        path, extracting it if the album has not been seen before.
+        Returns None if the album has no art.
+        """
+        # Untagged files are grouped by directory
+        key = '%s\0%s' % (artist, album) if album else os.path.dirname(path)
+        with self._lock:
+            album_lock = self._album_locks.setdefault(key, threading.Lock())
+        # Only the first request for an album extracts the art,
+        # concurrent requests wait for the result
+        with album_lock:
+            try:
+                with self._lock:
+                    row = self.conn.execute(
+                        """SELECT hash, checked FROM album_art WHERE album_key=?""", (key,)
+                    ).fetchone()
+                if row is not None and (row[0] is not None or
+                                        time.time() - row[1] < self.RETRY_INTERVAL):
+                    return row[0]
+                art_hash = self._extract(path)
+                with self._lock:
+                    self.conn.execute(
+                        """INSERT OR REPLACE INTO album_art VALUES (?, ?, ?)""",
+                        (key, art_hash, time.time())
+                    )
+                    self.conn.commit()
+                return art_hash
+            finally:
+                with self._lock:
+                    self._album_locks.pop(key, None)
+
+    def get_path(self, art_hash, size=None):
+        """Returns the path of the image, or its thumbnail of the given
+        width, or None if it is not in the cache. Falls back to the full
+        size image if the thumbnail could not be created.
+        """
+        if size is not None:
+            thumbnail = self._get_file_name(art_hash, size)
+            if os.path.exists(thumbnail):
+                return thumbnail
+        for _, ext in self.__IMAGE_SIGNATURES:
+            path = self._get_file_name(art_hash, ext=ext)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _get_file_name(self, art_hash, size=None, ext='jpg'):
+        if size is not None:
+            return os.path.join(self.art_dir, '%s.%i.jpg' % (art_hash, size))
+        return os.path.join(self.art_dir, '%s.%s' % (art_hash, ext))
+
+    def _extract(self, path):
+        """Finds the art for the media file, storing the image and its
+        thumbnails if they are not already cached. Returns the hash of
+        the image, or None if there is none.
+        """
+        image, ext = self._read_folder_image(os.path.dirname(path))
+        if image is None:
+            image, ext = self._read_embedded_image(path)
+        if image is None:
+            return None
+        art_hash = hashlib.sha1(image).hexdigest()
+        file_name = self._get_file_name(art_hash, ext=ext)
+        if not os.path.exists(file_name):
+            self.logger.info("Adding album art for %s" % path)
+            self._write_file(file_name, image)
+            for size in self.sizes:
+                self._create_thumbnail(file_name, art_hash, size)
+        return art_hash
+
+    def _read_folder_image(self, directory):
+        """Returns the contents and extension of the preferred image in
+        the directory, or (None, None)
+        """
+        try:
+            entries = dict((entry.lower(), entry) for entry in os.listdir(directory))
+        except OSError as e:
+            self.logger.warning(str(e))
+            return None, None
+        for name in self.FOLDER_IMAGES.split(','):
+            if name in entries:
+                try:
+                    with open(os.path.join(directory, entries[name]), 'rb') as image:
+                        return image.read(), os.path.splitext(name)[1][1:]
+                except IOError as e:
+                    self.logger.warning(str(e))
+        return None, None
+
+    def _read_embedded_image(self, path):
+        """Returns the contents and extension of the picture embedded in
+        the media file, or (None, None). The picture is copied as is, and
+        its extension chosen from its format.
+        """
+        cmd = ['ffmpeg', '-v', 'error', '-i', path, '-an', '-map', '0:v:0',
+               '-c:v', 'copy', '-f', 'image2pipe', '-']
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        image, _ = proc.communicate()
+        if proc.returncode != 0 or len(image) == 0:
+            return None, None
+        for signature, ext in self.__IMAGE_SIGNATURES:
+            if image.startswith(signature):
+                return image, ext
+        self.logger.warning("Unknown format of the picture embedded in %s" % path)
+        return None, None
+
+    def _create_thumbnail(self, file_name, art_hash, size):
+        """Scales the image to fit within size pixels, using ffmpeg"""
+        thumbnail = self._get_file_name(art_hash, size)
+        part_file = '%s.%i.part' % (thumbnail, os.getpid())
+        cmd = ['ffmpeg', '-v', 'error', '-i', file_name,
+               '-vf', 'scale=%i:%i:force_original_aspect_ratio=decrease' % (size, size),
+               '-f', 'image2', '-c:v', 'mjpeg', '-y', part_file]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, stderr = proc.communicate()
+        if proc.returncode != 0:
+            self.logger.warning("Failed to create thumbnail of %s: %s" % (file_name, stderr))
+            if os.path.exists(part_file):
+                os.unlink(part_file)
+            return
+        os.rename(part_file, thumbnail)
+
+    def _write_file(self, file_name, data):
+        """Writes the file atomically, via a partial file"""
+        part_file = '%s.%i.part' % (file_name, os.getpid())
+        with open(part_file, 'wb') as out:
+            out.write(data)
+        os.rename(part_file, file_name)
@@ -0,0 +1,271 @@
+import os
+import time
+import errno
+import sqlite3
+import threading
+from config import ComponentBase, config
+
+__all__ = ["TranscodeCache"]
+
+
+class TranscodeCache(ComponentBase):
+    """Size bounded cache of transcoded files. Entries are recorded in an
+    index database, which is shared by every process using the cache, so
+    the cache directory does not need to be scanned on startup. Once the
+    cache grows beyond MAX_SIZE the least recently used entries (or least
+    frequently used, with the 'lfu' policy) are evicted.
+
+    Files are written under the partial directory and renamed into place
+    once complete. Partial files left behind by processes which have
+    exited are removed on startup.
+    """
+
+    # Maximum total size of the cached files in bytes
+    MAX_SIZE = 10 * 1024 ** 3
+    # Eviction policy, either 'lru' or 'lfu'
+    POLICY = 'lru'
+
+    __SCHEMA = """\
+create table if not exists cache_entry (
+  media_id integer,
+  format text,
+  path text not null,
+  size integer not null, -- size in bytes
+  atime real not null, -- last access time in seconds
+  hits integer not null default 0,
+  primary key (media_id, format)
+);
+"""
+
+    # Index upgrades, the index user_version holds the number applied
+    __MIGRATIONS = (
+        """\
+alter table cache_entry add column verified integer not null default 0;
+""",
+        """\
+alter table cache_entry add column prefetched integer not null default 0; -- 1 until first played
+""",
+    )
+
+    __EVICTION_ORDER = {
+        'lru': 'atime',
+        'lfu': 'hits, atime',
+    }
+
+    def __init__(self, cache_dir=config.CACHE_DIR, index_file=config.CACHE_INDEX):
+        super(TranscodeCache, self).__init__()
+        self._load_config()
+        if self.POLICY not in self.__EVICTION_ORDER:
+            self.logger.warning("Unknown eviction policy %s, using lru" % self.POLICY)
+            self.POLICY = 'lru'
+        self.cache_dir = cache_dir
+        self.partial_dir = os.path.join(cache_dir, 'partial')
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        index_required = not os.path.exists(index_file)
+        self.conn = sqlite3.connect(index_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.executescript(self.__SCHEMA)
+        self._migrate()
+        if index_required:
+            self._index_cache_dir()
+        self._remove_orphaned_files()
+
+    def _migrate(self):
+        """Applies any outstanding index upgrades"""
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        for version, script in enumerate(self.__MIGRATIONS[version:], version + 1):
+            self.conn.executescript(
+                "BEGIN;\n%sPRAGMA user_version = %i;\nCOMMIT;" % (script, version)
+            )
+
+    def _remove_orphaned_files(self):
+        """Removes partial files left by processes which are no longer running"""
+        if not os.path.isdir(self.partial_dir):
+            os.mkdir(self.partial_dir)
+            return
+        for entry in os.listdir(self.partial_dir):
+            pid = entry.split('.')[-2]
+            if pid.isdigit() and self._is_running(int(pid)):
+                continue
+            self.logger.info("Removing orphaned partial file %s" % entry)
+            try:
+                os.unlink(os.path.join(self.partial_dir, entry))
+            except OSError as e:
+                self.logger.warning(str(e))
+
+    @staticmethod
+    def _is_running(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno == errno.EPERM
+        return True
+
+    def get_partial_file_name(self, media_id, file_format):
+        """Returns the name for an in progress file, which is unique
+        to the current process
+        """
+        return os.path.join(
+            self.partial_dir, "%s.%s.%s.part" % (media_id, file_format, os.getpid())
+        )
+
+    def _index_cache_dir(self):
+        """Adds any existing files in the cache directory to the index"""
+        count = 0
+        for entry in os.listdir(self.cache_dir):
+            # Files are named <id>.<format>, where segment formats contain a dot
+            name, _, file_format = entry.partition('.')
+            if name.isdigit() and file_format:
+                count += 1
+                self.add(int(name), os.path.join(self.cache_dir, entry), file_format)
+        self.logger.info("Indexed %s existing items in the cache" % count)
+
+    def add(self, media_id, path, file_format=None, verified=False, prefetched=False):
+        """Adds a file to the cache, evicting other entries if the
+        cache is over its size limit. Files which are not known to be
+        complete are verified on first use. Prefetched files count
+        towards prefetched_size until they are first played.
+        """
+        if file_format is None:
+            file_format = os.path.splitext(path)[1][1:]
+        size = os.lstat(path).st_size
+        with self._lock:
+            self.conn.execute(
+                """INSERT OR REPLACE INTO cache_entry
+                (media_id, format, path, size, atime, verified, prefetched)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (media_id, file_format, path, size, time.time(), int(verified), int(prefetched))
+            )
+            self.conn.commit()
+        self.evict()
+
+    def get(self, media_id, file_format, verify=None):
+        """Gets the path of the cached file, recording the access,
+        or returns None if there is no cached file. Entries whose file
+        has changed size, or which are not yet verified and fail the
+        optional verify function, are removed.
+        """
+        with self._lock:
+            row = self.conn.execute(
+                """SELECT path, size, verified FROM cache_entry WHERE media_id=? AND format=?""",
+                (media_id, file_format)
+            ).fetchone()
+        if row is not None:
+            path, size, verified = row
+            if not self._check_file(path, size, verified, verify):
+                self.logger.warning("Removing invalid cache file %s" % path)
+                self.remove(media_id, file_format)
+                row = None
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute(
+                """UPDATE cache_entry SET atime=?, hits=hits + 1, verified=1, prefetched=0
+                WHERE media_id=? AND format=?""",
+                (time.time(), media_id, file_format)
+            )
+            self.conn.commit()
+            return path
+
+    @staticmethod
+    def _check_file(path, size, verified, verify):
+        try:
+            if os.lstat(path).st_size != size:
+                return False
+        except OSError:
+            return False
+        return verified or verify is None or verify(path)
+
+    def formats(self, media_id):
+        """Returns the list of formats cached for the item"""
+        with self._lock:
+            rows = self.conn.execute(
+                """SELECT format FROM cache_entry WHERE media_id=?""", (media_id,)
+            ).fetchall()
+        return [file_format for file_format, in rows]
+
+    def most_hit(self, limit):
+        """Returns the ids of up to limit items with the most cache hits,
+        summed over their cached formats, most hit first
+        """
+        with self._lock:
+            rows = self.conn.execute(
+                """SELECT media_id FROM cache_entry GROUP BY media_id
+                ORDER BY sum(hits) DESC LIMIT ?""", (limit,)
+            ).fetchall()
+        return [media_id for media_id, in rows]
+
+    def remove(self, media_id, file_format=None):
+        """Removes the cached files for the item, in the given format or
+        all formats.
+        """
+        with self._lock:
+            query = """SELECT media_id, format, path FROM cache_entry WHERE media_id=?"""
+            params = (media_id,)
+            if file_format is not None:
+                query += " AND format=?"
+                params += (file_format,)
+            for entry in self.conn.execute(query, params).fetchall():
+                self._remove_entry(*entry)
+            self.conn.commit()
+
+    def evict(self):
+        """Evicts entries until the cache is within MAX_SIZE"""
+        with self._lock:
+            total = self._size()
+            if total <= self.MAX_SIZE:
+                return
+            cursor = self.conn.execute(
+                """SELECT media_id, format, path, size FROM cache_entry ORDER BY %s"""
+                % self.__EVICTION_ORDER[self.POLICY]
+            )
+            for media_id, file_format, path, size in cursor.fetchall():
+                if total <= self.MAX_SIZE:
+                    break
+                self.logger.info("Evicting %s from the cache" % path)
+                self._remove_entry(media_id, file_format, path)
+                self.evictions += 1
+                total -= size
+            self.conn.commit()
+
+    def _remove_entry(self, media_id, file_format, path):
+        try:
+            os.unlink(path)
+        except OSError as e:
+            self.logger.warning(str(e))
+        self.conn.execute(
+            """DELETE FROM cache_entry WHERE media_id=? AND format=?""", (media_id, file_format)
+        )
+
+    def size(self):
+        """Returns the total size of the cached files in bytes"""
+        with self._lock:
+            return self._size()
+
+    def _size(self):
+        return self.conn.execute("""SELECT coalesce(sum(size), 0) FROM cache_entry""").fetchone()[0]
+
+    def prefetched_size(self):
+        """Returns the total size in bytes of the prefetched files which
+        have not been played
+        """
+        with self._lock:
+            return self.conn.execute(
+                """SELECT coalesce(sum(size), 0) FROM cache_entry WHERE prefetched=1"""
+            ).fetchone()[0]
+
+    def stats(self):
+        """Returns a dict of the cache size and hit, miss and eviction counts"""
+        with self._lock:
+            size = self._size()
+            count = self.conn.execute("""SELECT count(*) FROM cache_entry""").fetchone()[0]
+        return {
+            'entries': count, 'size': size, 'max_size': self.MAX_SIZE,
+            'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions
+        }
@@ -28,6 +28,7 @@ AddType audio/webm .webm
 
 XSendFile On
 XSendFilePath %(cache_dir)s/
+XSendFilePath %(art_dir)s/
 
 <Location />
   Require all granted
@@ -77,6 +78,12 @@ class config(object):
     ENV_DIR = _ENV_DIR
     # Transcode cache directory
     CACHE_DIR = os.path.join(_ENV_DIR, 'cache')
+    # Transcode cache index file name
+    CACHE_INDEX = os.path.join(_ENV_DIR, 'cache.db')
+    # Album art cache directory
+    ART_DIR = os.path.join(_ENV_DIR, 'art')
+    # Album art cache index file name
+    ART_INDEX = os.path.join(_ENV_DIR, 'art.db')
     # Log file name
     LOG_FILE = os.path.join(_ENV_DIR, 'app.log')
     # Db file name
@@ -114,8 +121,17 @@ class config(object):
 
     @classmethod
     def save_config_section(cls, section, config_dict):
-        """Saves the options in config_dict under the given section"""
-        pass
+        """Saves the options in config_dict under the given section,
+        keeping any other options and sections in the config file
+        """
+        parser = SafeConfigParser()
+        parser.read(cls.CONF_FILE)
+        if not parser.has_section(section):
+            parser.add_section(section)
+        for key, value in config_dict.iteritems():
+            parser.set(section, key, value)
+        with open(cls.CONF_FILE, 'w') as conf_file:
+            parser.write(conf_file)
 
     @classmethod
     def create_apache_config(cls):
@@ -125,7 +141,7 @@ class config(object):
             apache_config.write(
                 _APACHE_CONF_TMPL % {
                     'install': install_dir, 'env': cls.ENV_DIR, 'name': cls.APP_NAME,
-                    'cache_dir': cls.CACHE_DIR
+                    'cache_dir': cls.CACHE_DIR, 'art_dir': cls.ART_DIR
                 }
             )
 
@@ -148,18 +164,23 @@ class ComponentBase(object):
     def __init__(self):
         self.logger = logging.getLogger(self.__class__.__name__)
 
-    def _load_config(self):
-        """Loads the config for a given component"""
-        conf = config.load_config_section(self.__class__.__name__.lower())
+    def _load_config(self, section=None):
+        """Loads the config for a given component, from the section
+        named after the class unless another section is given
+        """
+        conf = config.load_config_section(section or self.__class__.__name__.lower())
         if conf is not None:
             for key, value in conf.iteritems():
                 # Set constants defined in the config
+                if not hasattr(self, key.upper()):
+                    self.logger.warning("Unknown option %s in config" % key)
+                    continue
+                attr_type = type(getattr(self, key.upper()))
                 try:
-                    attr_type = type(getattr(self, key.upper()))
-                    if type is int:
-                        value = int(value)
-                    elif type is bool:
-                        value = strtobool(value)
+                    if attr_type is bool:
+                        value = bool(strtobool(value))
+                    elif attr_type in (int, long, float):
+                        value = attr_type(value)
                     setattr(self, key.upper(), value)
                 except ValueError:
                     self.logger.warning(
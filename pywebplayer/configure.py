@@ -23,6 +23,8 @@ def create_environment():
     config.create_wsgi_script(entry.pw_uid, entry.pw_gid)
     os.mkdir(config.CACHE_DIR)
     os.chown(config.CACHE_DIR, entry.pw_uid, entry.pw_gid)
+    os.mkdir(config.ART_DIR)
+    os.chown(config.ART_DIR, entry.pw_uid, entry.pw_gid)
 
 
 def setup_apache():
@@ -51,9 +53,18 @@ def discover_files():
     path = raw_input('Media directory [%s]: ' % default_search_path)
     path = path or default_search_path
     with MediaLibrary() as library:
-        discovery = MediaDiscovery(library)
-        items_found = discovery.search([path])
-        print "Indexed %s items" % items_found
+        discovery = MediaDiscovery(library, progress=_print_progress)
+        items_found = discovery.search([path], incremental=True)
+        print "\nIndexed %s items" % items_found
+    # Let the watcher, running as www-data, update the library
+    entry = pwd.getpwnam('www-data')
+    os.chown(config.DB_FILE, entry.pw_uid, entry.pw_gid)
+
+
+def _print_progress(found, indexed):
+    """Prints the discovery progress on a single line"""
+    sys.stdout.write("\rProbed %s files, indexed %s items" % (found, indexed))
+    sys.stdout.flush()
 
 
 def main():
@@ -1,58 +1,342 @@
 import os
+import sys
 import time
+import sqlite3
+import logging
+import threading
+from multiprocessing import cpu_count
+from Queue import Queue
 
-from config import ComponentBase
+from config import ComponentBase, config
+from model import MediaLibrary
 from transcode import Transcoder
+from watch import create_watcher
 
 
 class MediaDiscovery(ComponentBase):
+    """Scans directories for media files. Files are probed by a
+    pool of worker threads, each running ffprobe, and the results
+    are written back to the library in batches.
+    """
 
-    DURATION_FORMAT = '%H:%M:%S'
     MAX_DEPTH = 4
+    # Number of concurrent ffprobe workers
+    WORKERS = cpu_count()
+    # Number of probed items passed to the library at once
+    BATCH_SIZE = 100
+    # Seconds without further events before a watched change is applied
+    DEBOUNCE = 2
 
-    def __init__(self, library):
+    def __init__(self, library, workers=None, progress=None):
+        """The optional progress callback is called with the number of
+        files found and the number of items indexed after each batch.
+        """
         super(MediaDiscovery, self).__init__()
+        self._load_config()
         self.library = library
+        self.workers = workers or self.WORKERS
+        self.progress = progress
+        self.transcoder = Transcoder()
 
-    def search(self, paths, depth=0):
-        """Search the given paths for media files"""
-        num_items = 0
-        sub_paths = []
-        tcoder = Transcoder()
-        if len(paths) == 0 or depth >= self.MAX_DEPTH:
-            return 0
+    def search(self, paths, incremental=False):
+        """Search the given paths for media files.
+        When incremental is set, files whose size, mtime and inode are
+        unchanged since the last scan are not probed again, and items
+        for files which no longer exist are removed.
+        Returns the number of items indexed.
+        """
+        with self.library.bulk_load():
+            return self._search(paths, incremental)
+
+    def _search(self, paths, incremental, add_roots=True):
+        signatures = {}
         for path in paths:
-            try:
-                for entry in os.listdir(path):
-                    abspath = os.path.join(path, entry)
-                    if os.path.isdir(abspath):
-                        sub_paths.append(abspath)
-                        continue
-                    name, ext = os.path.splitext(entry)
-                    ext = ext[1:]
-                    if ext in tcoder.MIME_MAP:
-                        info = tcoder.get_media_info(abspath)
-                        if info is None:
-                            continue
-                        size = os.stat(abspath).st_size
-                        length = self._duration_to_secs(info['duration'])
-                        self.library.insert(name, abspath, length, size,
-                                            tcoder.MIME_MAP[ext], info, ignore_duplicates=True)
-                    num_items += 1
-            except OSError as e:
-                self.logger.warning(str(e))
+            path = os.path.abspath(path)
+            if add_roots:
+                self.library.add_root(path)
+            if incremental:
+                signatures.update(self.library.get_signatures(path))
+        self.library.save()
+        scan = _Scan(signatures, incremental)
+
+        # Bound the work queue so the walker cannot run far ahead of the probes
+        work_queue = Queue(maxsize=self.workers * 4)
+        result_queue = Queue()
+        walker = threading.Thread(target=self._walk, args=(paths, work_queue, scan))
+        walker.daemon = True
+        walker.start()
+        for _ in range(self.workers):
+            probe = threading.Thread(target=self._probe_worker, args=(work_queue, result_queue))
+            probe.daemon = True
+            probe.start()
+
+        found = 0
+        num_items = 0
+        batch = []
+        finished_workers = 0
+        while finished_workers < self.workers:
+            result = result_queue.get()
+            if result is None:
+                finished_workers += 1
+                continue
+            found += 1
+            if result[-1] is None:
+                continue
+            batch.append(result)
+            if len(batch) >= self.BATCH_SIZE:
+                num_items += self._save_batch(batch)
+                batch = []
+                self._report_progress(found, num_items)
+        num_items += self._save_batch(batch)
+        self._report_progress(found, num_items)
+        walker.join()
+        if scan.error is not None:
+            # Items not reached by the walk must not be removed as missing
+            raise scan.error[0], scan.error[1], scan.error[2]
+        if incremental:
+            removed = scan.missing_paths()
+            self.library.delete_paths(removed)
             self.library.save()
-        return self.search(sub_paths, depth + 1) + num_items
+            self.logger.info("%s items unchanged, %s items removed" % (scan.unchanged, len(removed)))
+        return num_items
+
+    def _walk(self, paths, work_queue, scan):
+        """Walk the given paths breadth first, up to MAX_DEPTH, putting
+        each new or modified media file on the work queue. Always puts one
+        None per worker when finished, so the workers are not left waiting.
+        If the walk fails, the error is recorded in scan.error.
+        """
+        try:
+            paths = [os.path.abspath(path) for path in paths]
+            depth = 0
+            while len(paths) > 0 and depth < self.MAX_DEPTH:
+                sub_paths = []
+                for path in paths:
+                    try:
+                        for entry in os.listdir(path):
+                            if isinstance(path, unicode) and not isinstance(entry, unicode):
+                                # Not decodable with the filesystem encoding
+                                self.logger.warning(
+                                    "Skipping undecodable file name %r in %s" % (entry, path)
+                                )
+                                continue
+                            abspath = os.path.join(path, entry)
+                            if os.path.isdir(abspath):
+                                sub_paths.append(abspath)
+                                continue
+                            name, ext = os.path.splitext(entry)
+                            mime_type = self.transcoder.MIME_MAP.get(ext[1:])
+                            if mime_type is not None and scan.is_modified(abspath):
+                                work_queue.put((name, abspath, mime_type))
+                    except OSError as e:
+                        scan.failed_dirs.append(os.path.join(path, ''))
+                        self.logger.warning(str(e))
+                paths = sub_paths
+                depth += 1
+        except Exception:
+            self.logger.exception("Failed to walk the media directories")
+            scan.error = sys.exc_info()
+        finally:
+            for _ in range(self.workers):
+                work_queue.put(None)
+
+    def _probe_worker(self, work_queue, result_queue):
+        """Probes files from the work queue until a None is received.
+        Always puts a None on the result queue when finished, so the
+        search is not left waiting for the worker.
+        """
+        try:
+            while True:
+                work = work_queue.get()
+                if work is None:
+                    return
+                result_queue.put(self._probe(*work))
+        finally:
+            result_queue.put(None)
+
+    def _probe(self, name, abspath, mime_type):
+        """Probes a file, returning a tuple of the name, path, stat result,
+        mime type and media info. The media info is None if the file
+        could not be probed.
+        """
+        stat = info = None
+        try:
+            stat = os.stat(abspath)
+            info = self.transcoder.get_media_info(abspath)
+        except OSError as e:
+            self.logger.warning(str(e))
+        except Exception:
+            # A file which breaks the probe must not stop the scan
+            self.logger.exception("Failed to probe %s" % abspath)
+            info = None
+        if info is not None and info['duration'] is None:
+            self.logger.warning("No duration found for %s" % abspath)
+            info = None
+        return name, abspath, stat, mime_type, info
+
+    def _save_batch(self, batch):
+        """Inserts a batch of probed files"""
+        return self.library.insert_many((
+            {'name': name, 'path': abspath, 'length': int(round(info['duration'])),
+             'size': stat.st_size, 'mime_type': mime_type, 'props': info['tags'],
+             'mtime': stat.st_mtime, 'inode': stat.st_ino, 'duration': info['duration'],
+             'codec': info['codec'], 'bitrate': info['bitrate'],
+             'sample_rate': info['sample_rate'], 'channels': info['channels']}
+            for name, abspath, stat, mime_type, info in batch
+        ), ignore_duplicates=True)
 
-    def _duration_to_secs(self, duration):
-        """Converts a duration string into seconds"""
-        # TODO - Support sub second precision
-        ts = time.strptime(duration, self.DURATION_FORMAT)
-        return ts.tm_hour * 3600 + ts.tm_min * 60 + ts.tm_sec
+    def _report_progress(self, found, indexed):
+        self.logger.info("Probed %s files, indexed %s items" % (found, indexed))
+        if self.progress is not None:
+            self.progress(found, indexed)
 
-    def start_watching(self):
+    def start_watching(self, paths=None):
         """Watch the filesystem for any new media files
         and add them to the database automatically.
+        Watches the given paths, or the directories previously searched.
+        Changes are applied by a daemon thread with its own library
+        connection, once no further events have been seen for DEBOUNCE
+        seconds. Returns the thread.
+        Raises ValueError if there are no paths to watch.
+        """
+        if paths is None:
+            paths = self.library.get_roots()
+        if len(paths) == 0:
+            raise ValueError("No media directories to watch")
+        paths = [os.path.abspath(path) for path in paths]
+        watcher = threading.Thread(target=self._run_watcher, args=(paths,))
+        watcher.daemon = True
+        watcher.start()
+        return watcher
+
+    def _run_watcher(self, paths):
+        with MediaLibrary(self.library.db_file) as library:
+            MediaDiscovery(library, self.workers)._watch(paths)
+
+    def _watch(self, paths):
+        """Collects the changed paths from the watcher, applying each
+        path once it has been quiet for DEBOUNCE seconds
+        """
+        watcher = create_watcher(paths, self.MAX_DEPTH)
+        self.logger.info("Watching %s for changes" % ', '.join(paths))
+        pending = {}  # Changed path to the time of its last event
+        try:
+            while True:
+                timeout = None
+                if len(pending) > 0:
+                    timeout = max(min(pending.values()) + self.DEBOUNCE - time.time(), 0)
+                for path in watcher.read(timeout):
+                    pending[path] = time.time()
+                now = time.time()
+                ready = [path for path, seen in pending.items() if now - seen >= self.DEBOUNCE]
+                for path in ready:
+                    del pending[path]
+                for start in range(0, len(ready), self.BATCH_SIZE):
+                    self._apply_batch(ready[start:start + self.BATCH_SIZE])
+        finally:
+            watcher.close()
+
+    def _apply_batch(self, paths):
+        """Applies the changed paths together, or if that fails, each path
+        on its own so a bad path does not lose the other changes
+        """
+        try:
+            self._apply_changes(paths)
+        except (OSError, sqlite3.Error) as e:
+            if len(paths) == 1:
+                self.logger.error("Failed to apply changes to %s: %s" % (paths[0], str(e)))
+                return
+            self.logger.warning("Failed to apply changes, retrying each path: %s" % str(e))
+            for path in paths:
+                self._apply_batch([path])
+
+    def _apply_changes(self, paths):
+        """Updates the library for changed paths. Changed media files are
+        probed again, directories are searched, and items for paths which
+        no longer exist are removed. Cached transcodes of the replaced and
+        removed items are deleted.
+        """
+        dirs = []
+        files = []
+        removed = []
+        for path in paths:
+            if os.path.isdir(path):
+                dirs.append(path)
+            elif os.path.isfile(path):
+                name, ext = os.path.splitext(os.path.basename(path))
+                mime_type = self.transcoder.MIME_MAP.get(ext[1:])
+                if mime_type is not None:
+                    files.append((name, path, mime_type))
+            else:
+                removed.append(path)
+        # Removed directories take any items within them
+        for path in list(removed):
+            removed.extend(self.library.get_signatures(path))
+        stale_ids = self.library.get_ids(removed + [path for _, path, _ in files])
+        self.library.delete_paths(removed)
+        self.library.save()
+        batch = [result for result in (self._probe(*work) for work in files) if result[-1] is not None]
+        self._save_batch(batch)
+        if len(dirs) > 0:
+            self._search(dirs, incremental=True, add_roots=False)
+        for media_id in stale_ids.itervalues():
+            self.transcoder.cache.remove(media_id)
+        self.logger.info("Updated %s items, removed %s paths" % (len(batch), len(removed)))
+
+
+class _Scan(object):
+    """Tracks the files seen during a scan, comparing them against
+    the signatures stored in the library.
+    """
+
+    def __init__(self, signatures, incremental):
+        self.signatures = signatures
+        self.incremental = incremental
+        self.seen = set()
+        self.failed_dirs = []
+        self.unchanged = 0
+        self.error = None  # exc_info of a failed walk
+
+    def is_modified(self, path):
+        """Returns True if the file at path should be probed"""
+        self.seen.add(path)
+        if not self.incremental or path not in self.signatures:
+            return True
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return True
+        if self.signatures[path] == (stat.st_size, stat.st_mtime, stat.st_ino):
+            self.unchanged += 1
+            return False
+        return True
+
+    def missing_paths(self):
+        """Returns the stored paths which were not seen during the scan,
+        excluding any within directories which could not be read.
         """
-        pass
-        # TODO - Implement file system watching
+        return [
+            path for path in self.signatures
+            if path not in self.seen and not any(path.startswith(d) for d in self.failed_dirs)
+        ]
+
+
+def main():
+    """Entry point for the watcher script, which keeps the library up
+    to date with changes to the media directories until interrupted
+    """
+    config.setup_logging(logging.INFO)
+    with MediaLibrary() as library:
+        try:
+            watcher = MediaDiscovery(library).start_watching()
+        except ValueError as e:
+            # Libraries scanned before the roots were recorded have none
+            logging.getLogger(__name__).error(str(e))
+            print >> sys.stderr, "%s, run pywebplayer-setup to scan the media directory" % str(e)
+            return 1
+    while watcher.is_alive():
+        watcher.join(1)  # Wake periodically so KeyboardInterrupt is handled
+
+
+if __name__ == '__main__':
+    sys.exit(main())
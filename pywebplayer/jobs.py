@@ -0,0 +1,455 @@
+import os
+import heapq
+import signal
+import tempfile
+import itertools
+import threading
+import subprocess
+from multiprocessing import cpu_count
+from config import ComponentBase
+
+__all__ = ["TranscodeJob", "JobRegistry", "TranscodeScheduler"]
+
+
+class TranscodeJob(ComponentBase):
+    """A single ffmpeg transcode. The ffmpeg output is piped back and
+    written to a partial file by a background thread, while any number
+    of clients stream the file as it grows. Once ffmpeg succeeds the
+    partial file is synced and renamed to the output file, so the output
+    file is never seen incomplete. Containers whose index is only written
+    to seekable output are remuxed into the output file instead.
+    """
+
+    BUF_SIZE = 65536
+
+    def __init__(self, cmd, out_file, part_file, media_id, container, on_complete=None,
+                 remux=None):
+        """The on_complete callback is called with the job once ffmpeg
+        has exited, followed by any listeners, before any waiting clients
+        are released. If out_file is None the output is only streamed,
+        and the partial file is removed once the job is complete. If
+        remux is a list of ffmpeg output options, the partial file is
+        copied into the output file with those options.
+        """
+        super(TranscodeJob, self).__init__()
+        self.cmd = cmd
+        self.out_file = out_file
+        self.part_file = part_file
+        self.path = part_file  # Current location of the output, or None if removed
+        self.media_id = media_id
+        self.container = container
+        self.on_complete = on_complete
+        self.remux = remux
+        self.priority = None  # Set when submitted to a scheduler
+        self.proc = None
+        self.stderr = None
+        self.bytes_written = 0
+        self.started = False
+        self.succeeded = False  # Set once the output file is in place
+        self.cancelled = False
+        self.done = False
+        self._listeners = []
+        self._readers = 0  # Number of clients streaming the partial file
+        self._cond = threading.Condition()
+
+    @property
+    def returncode(self):
+        return self.proc.returncode if self.proc is not None else None
+
+    def add_listener(self, listener):
+        """Adds a function to be called with the job once it is complete"""
+        self._listeners.append(listener)
+
+    def start(self):
+        """Starts ffmpeg and the thread writing its output"""
+        # Send stderr to a temporary file for later reading
+        self.stderr = tempfile.TemporaryFile()
+        if self.cancelled:
+            self._complete()
+            return self
+        try:
+            out = open(self.part_file, 'wb')
+            try:
+                self.proc = subprocess.Popen(self.cmd, stdout=subprocess.PIPE, stderr=self.stderr)
+            except OSError:
+                out.close()
+                os.unlink(self.part_file)
+                raise
+        except (IOError, OSError) as e:
+            self.logger.error("Failed to start ffmpeg: %s" % str(e))
+            self._complete()
+            return self
+        with self._cond:
+            self.started = True
+            self._cond.notify_all()
+        writer = threading.Thread(target=self._write_output, args=(out,))
+        writer.daemon = True
+        writer.start()
+        return self
+
+    def _write_output(self, out):
+        """Copies the ffmpeg output to the partial file until ffmpeg exits,
+        then moves the partial file into place if ffmpeg succeeded.
+        """
+        write_failed = False
+        try:
+            with out:
+                fd = self.proc.stdout.fileno()
+                while True:
+                    buf = os.read(fd, self.BUF_SIZE)
+                    if not buf:
+                        break
+                    out.write(buf)
+                    out.flush()
+                    with self._cond:
+                        self.bytes_written += len(buf)
+                        self._cond.notify_all()
+                os.fsync(out.fileno())
+        except (IOError, OSError) as e:
+            self.logger.error("Failed to write %s: %s" % (self.part_file, str(e)))
+            write_failed = True
+            self.proc.kill()
+        finally:
+            self.proc.stdout.close()
+            self.proc.wait()
+            try:
+                self._finish_output(write_failed)
+            except OSError as e:
+                self.logger.error("Failed to save %s: %s" % (self.out_file, str(e)))
+            finally:
+                self._complete()
+
+    def _finish_output(self, write_failed):
+        """Renames the partial file on success, or removes it"""
+        if write_failed or self.proc.returncode != 0 or self.out_file is None:
+            with self._cond:
+                os.unlink(self.part_file)
+                self.path = None
+            return
+        if self.remux is not None and self._remux_output():
+            with self._cond:
+                # Readers of the partial file keep reading it through their open
+                # file, later readers read the remuxed output file
+                os.unlink(self.part_file)
+                self.path = None
+                self.succeeded = True
+        else:
+            with self._cond:
+                os.rename(self.part_file, self.out_file)
+                self.path = self.out_file
+                self.succeeded = True
+        # Sync the directory so the rename survives a crash
+        dir_fd = os.open(os.path.dirname(self.out_file), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _remux_output(self):
+        """Copies the partial file into the output file with the remux
+        options, so the index and duration are written. Returns False
+        if the remux failed, in which case the output file is not written.
+        """
+        # Keep the pid second from last, for the orphaned file cleanup
+        name, pid, ext = self.part_file.rsplit('.', 2)
+        remux_file = '%s.remux.%s.%s' % (name, pid, ext)
+        cmd = ['ffmpeg', '-v', 'error', '-i', self.part_file, '-map', '0', '-c', 'copy']
+        cmd.extend(self.remux + ['-y', remux_file])
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, errors = proc.communicate()
+        if proc.returncode != 0:
+            self.logger.warning("Failed to remux %s: %s" % (self.part_file, errors))
+            if os.path.exists(remux_file):
+                os.unlink(remux_file)
+            return False
+        with open(remux_file, 'rb') as remuxed:
+            os.fsync(remuxed.fileno())
+        os.rename(remux_file, self.out_file)
+        return True
+
+    def _complete(self):
+        """Runs the completion callbacks and releases any waiting clients"""
+        try:
+            if self.on_complete is not None:
+                self.on_complete(self)
+        finally:
+            self.stderr.close()
+            try:
+                for listener in self._listeners:
+                    listener(self)
+            finally:
+                with self._cond:
+                    self.done = True
+                    self._cond.notify_all()
+
+    def cancel(self):
+        """Stops the transcode, or prevents it from starting if queued"""
+        self.cancelled = True
+        if self.proc is not None and self.proc.returncode is None:
+            try:
+                self.proc.terminate()
+            except OSError as e:
+                self.logger.warning(str(e))
+            self.resume()  # Let a suspended process handle the signal
+
+    def suspend(self):
+        """Pauses the ffmpeg process"""
+        self._signal(signal.SIGSTOP)
+
+    def resume(self):
+        """Resumes a paused ffmpeg process"""
+        self._signal(signal.SIGCONT)
+
+    def _signal(self, signum):
+        if self.proc is not None and self.proc.returncode is None:
+            try:
+                os.kill(self.proc.pid, signum)
+            except OSError as e:
+                self.logger.warning(str(e))
+
+    def read_errors(self):
+        """Returns the ffmpeg error output"""
+        self.stderr.seek(0)
+        return self.stderr.read()
+
+    def wait(self, timeout=None):
+        """Blocks until the transcode is complete, or for at most timeout
+        seconds. Returns the ffmpeg return code, or None if ffmpeg has not
+        exited.
+        """
+        with self._cond:
+            if timeout is not None:
+                if not self.done:
+                    self._cond.wait(timeout)
+            else:
+                while not self.done:
+                    self._cond.wait()
+        return self.returncode
+
+    def stream(self, buf_size=BUF_SIZE, offset=0, cancel_on_close=False):
+        """Generator yielding the transcoded output from the given offset,
+        following the output file until ffmpeg has finished. Waits for
+        the job to be started if it is queued. Closing the generator
+        early does not affect the transcode, unless cancel_on_close is set
+        or the output is only streamed and this was the last client.
+        """
+        with self._cond:
+            while not self.started and not self.done:
+                self._cond.wait()
+            if not self.started:
+                return
+            remuxed = self.path is None and self.succeeded
+            out = None
+            if self.path is not None:
+                # The partial file may be renamed or removed while reading,
+                # which does not affect an open file
+                out = open(self.path, 'rb')
+                self._readers += 1
+        if remuxed:
+            # The partial file was replaced by the remuxed output
+            for buf in self._read_output(buf_size, offset):
+                yield buf
+            return
+        if out is None:
+            return
+        finished = False
+        try:
+            with out:
+                out.seek(offset)
+                pos = offset
+                while True:
+                    with self._cond:
+                        while pos >= self.bytes_written and not self.done:
+                            self._cond.wait()
+                        available = self.bytes_written
+                    if pos >= available:
+                        break
+                    buf = out.read(min(buf_size, available - pos))
+                    pos += len(buf)
+                    yield buf
+            finished = True
+        finally:
+            with self._cond:
+                self._readers -= 1
+                last = self._readers == 0
+            if not finished and (cancel_on_close or (self.out_file is None and last)):
+                self.cancel()
+
+    def _read_output(self, buf_size, offset):
+        """Generator yielding the complete output file from offset"""
+        with open(self.out_file, 'rb') as out:
+            out.seek(offset)
+            while True:
+                buf = out.read(buf_size)
+                if not buf:
+                    break
+                yield buf
+
+    def status(self):
+        """Returns a dict describing the job"""
+        return {
+            'media_id': self.media_id, 'format': self.container, 'priority': self.priority,
+            'bytes_written': self.bytes_written
+        }
+
+
+class JobRegistry(object):
+    """Tracks the jobs in progress, keyed by (media_id, format), so that
+    concurrent requests for the same output share a single job.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def get_or_start(self, media_id, file_format, start):
+        """Returns the job in progress for the media id and format,
+        or calls start to create and start a new job if there is none.
+        """
+        key = (media_id, file_format)
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None or job.done or job.cancelled:
+                job = start()
+                self._jobs[key] = job
+            return job
+
+    def get(self, media_id, file_format):
+        """Returns the job in progress for the media id and format, or None"""
+        with self._lock:
+            job = self._jobs.get((media_id, file_format))
+        if job is not None and not job.done and not job.cancelled:
+            return job
+        return None
+
+    def find(self, media_id):
+        """Returns a list of the jobs in progress for the media id, in any format"""
+        with self._lock:
+            return [
+                job for (job_id, _), job in self._jobs.items()
+                if job_id == media_id and not job.done
+            ]
+
+    def remove(self, job):
+        """Removes a job once it is complete"""
+        key = (job.media_id, job.container)
+        with self._lock:
+            if self._jobs.get(key) is job:
+                del self._jobs[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._jobs)
+
+
+class TranscodeScheduler(ComponentBase):
+    """Runs submitted jobs in priority order, with at most MAX_CONCURRENT
+    ffmpeg processes running at once. When all slots are taken, a waiting
+    job preempts the lowest priority running job, which is suspended until
+    a slot becomes free. Jobs are started by a supervisor thread, which is
+    woken on each submission and job completion.
+    """
+
+    # Job priorities, lower values run first
+    INTERACTIVE = 0
+    BACKGROUND = 10
+    # Maximum number of ffmpeg processes running at once
+    MAX_CONCURRENT = cpu_count()
+
+    def __init__(self):
+        super(TranscodeScheduler, self).__init__()
+        self._load_config()
+        self._cond = threading.Condition()
+        self._pending = []  # Heap of (priority, sequence, job)
+        self._sequence = itertools.count()
+        self._running = []
+        self._suspended = []
+        self._supervisor = None
+
+    def submit(self, job, priority=BACKGROUND):
+        """Queues a job to be started. Returns the job."""
+        job.add_listener(self._on_job_done)
+        with self._cond:
+            self._push(job, priority)
+            if self._supervisor is None:
+                self._supervisor = threading.Thread(target=self._supervise)
+                self._supervisor.daemon = True
+                self._supervisor.start()
+            self._cond.notify()
+        return job
+
+    def prioritise(self, job, priority=INTERACTIVE):
+        """Raises the priority of a queued, running or suspended job"""
+        with self._cond:
+            if job.priority is None or priority >= job.priority:
+                return
+            if job in self._running or job in self._suspended:
+                job.priority = priority
+            else:
+                self._push(job, priority)  # The old heap entry becomes stale
+            self._cond.notify()
+
+    def _push(self, job, priority):
+        job.priority = priority
+        heapq.heappush(self._pending, (priority, next(self._sequence), job))
+
+    def _supervise(self):
+        """Starts queued jobs whenever there is a free slot"""
+        while True:
+            with self._cond:
+                job = self._schedule()
+                while job is None:
+                    self._cond.wait()
+                    job = self._schedule()
+            job.start()
+
+    def _schedule(self):
+        """Picks the next job to start, suspending or resuming running
+        jobs as required. Returns None if no job can be started.
+        """
+        while True:
+            # Drop heap entries for jobs which have since been reprioritised
+            while self._pending and self._pending[0][0] != self._pending[0][2].priority:
+                heapq.heappop(self._pending)
+            candidates = list(self._suspended)
+            if self._pending:
+                candidates.append(self._pending[0][2])
+            if len(candidates) == 0:
+                return None
+            # Favour suspended jobs over queued jobs of the same priority
+            job = min(candidates, key=lambda job: (job.priority, job not in self._suspended))
+            if len(self._running) >= self.MAX_CONCURRENT:
+                victim = max(self._running, key=lambda job: job.priority)
+                if victim.priority <= job.priority:
+                    return None
+                self.logger.info("Suspending transcode of %s" % victim.media_id)
+                victim.suspend()
+                self._running.remove(victim)
+                self._suspended.append(victim)
+            self._running.append(job)
+            if job in self._suspended:
+                self.logger.info("Resuming transcode of %s" % job.media_id)
+                self._suspended.remove(job)
+                job.resume()
+                continue
+            heapq.heappop(self._pending)
+            return job
+
+    def _on_job_done(self, job):
+        with self._cond:
+            if job in self._running:
+                self._running.remove(job)
+            if job in self._suspended:
+                self._suspended.remove(job)
+            self._cond.notify()
+
+    def status(self):
+        """Returns a dict describing the running, suspended and queued jobs"""
+        with self._cond:
+            pending = sorted(entry for entry in self._pending if entry[0] == entry[2].priority)
+            return {
+                'max_concurrent': self.MAX_CONCURRENT,
+                'running': [job.status() for job in self._running],
+                'suspended': [job.status() for job in self._suspended],
+                'pending': [job.status() for _, _, job in pending],
+            }
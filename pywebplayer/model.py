@@ -1,18 +1,32 @@
 import sqlite3
 import os
+import json
+import base64
+import threading
+from contextlib import contextmanager
 from functools import wraps
 from config import config, ComponentBase
 
 __all__ = ["MediaLibrary"]
 
 
+# Columns selected for each MediaItem
+_ITEM_COLUMNS = ("media.id, media.name, media.path, media.length, media.size, media.mime_type, "
+                 "media.artist, media.album, media.duration, media.codec, media.bitrate, "
+                 "media.sample_rate, media.channels")
+
+
+# Persistent connections, held per thread and keyed by (db_file, read_only)
+_thread_connections = threading.local()
+
+
 def with_rollback(func):
     """Decorator, providing auto rollback facilities"""
     @wraps(func)
     def wrapper(*args, **kwargs):
         self = args[0]
         try:
-            func(*args, **kwargs)
+            return func(*args, **kwargs)
         except Exception as e:
             self.logger.warning("Transaction failed, rolling back: %s" % str(e))
             self.conn.rollback()
@@ -22,22 +36,39 @@ def with_rollback(func):
 
 class MediaItem(object):
 
-    def __init__(self, media_id, name, path, length, size, mime_type, library):
+    __slots__ = ('id', 'path', 'name', 'length', 'size', 'mime_type', 'artist', 'album',
+                 'duration', 'codec', 'bitrate', 'sample_rate', 'channels', 'cached', 'props')
+
+    def __init__(self, media_id, name, path, length, size, mime_type, artist='', album='',
+                 duration=None, codec=None, bitrate=None, sample_rate=None, channels=None,
+                 props=None):
         self.id = media_id
         self.path = path
         self.name = name
         self.length = length
         self.size = size
         self.mime_type = mime_type
+        self.artist = artist
+        self.album = album
+        self.duration = duration  # Precise length in seconds
+        self.codec = codec
+        self.bitrate = bitrate  # Bits per second
+        self.sample_rate = sample_rate
+        self.channels = channels
         self.cached = False
-        self.library = library  # Back reference to the media library class
-        self.props = None  # Dict containing the media properties, lazily loaded.
+        self.props = props  # Dict containing the media properties, see MediaLibrary.load_props
 
     def __getitem__(self, key):
         if self.props is None:
-            self.props = self.library._get_props(self.id)
+            raise KeyError("Properties have not been loaded for item %s" % self.id)
         return self.props[key]
 
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
 
 class MediaLibrary(ComponentBase):
 
@@ -60,79 +91,465 @@ create table media_info (
 );
 """
 
-    def __init__(self, db_file=config.DB_FILE):
+    # Schema upgrades applied in order to existing and new databases.
+    # The database user_version holds the number of upgrades applied.
+    __MIGRATIONS = (
+        """\
+alter table media add column mtime real; -- modification time in seconds
+alter table media add column inode integer;
+
+create table media_root (
+  path text primary key -- Directory scanned by the media discovery
+);
+
+create trigger media_delete after delete on media begin
+  delete from media_info where media_id = old.id;
+end;
+""",
+        """\
+alter table media add column artist text not null default '';
+alter table media add column album text not null default '';
+
+update media set
+  artist = coalesce(
+    (select value from media_info where media_id = media.id and name = 'artist'), ''
+  ),
+  album = coalesce(
+    (select value from media_info where media_id = media.id and name = 'album'), ''
+  );
+
+create index media_name on media (name, id);
+create index media_artist on media (artist, album, name, id);
+create index media_album on media (album, name, id);
+""",
+        """\
+alter table media add column duration real; -- length in seconds
+alter table media add column codec text;
+alter table media add column bitrate integer; -- bits per second
+alter table media add column sample_rate integer;
+alter table media add column channels integer;
+
+update media set duration = length;
+""",
+    )
+
+    # Full text search index, created separately since FTS5 is not
+    # available in every sqlite build
+    __SEARCH_SCHEMA = """\
+create virtual table media_search using fts5(
+  name, artist, album, title, genre,
+  tokenize = 'unicode61 remove_diacritics 1', prefix = '2 3'
+);
+
+create trigger media_search_insert after insert on media begin
+  insert into media_search (rowid, name, artist, album)
+  values (new.id, new.name, new.artist, new.album);
+end;
+
+create trigger media_search_update after update of name, artist, album on media begin
+  update media_search set name = new.name, artist = new.artist, album = new.album
+  where rowid = new.id;
+end;
+
+create trigger media_search_delete after delete on media begin
+  delete from media_search where rowid = old.id;
+end;
+
+create trigger media_search_info after insert on media_info
+when new.name in ('title', 'genre') begin
+  update media_search set
+    title = case when new.name = 'title' then new.value else title end,
+    genre = case when new.name = 'genre' then new.value else genre end
+  where rowid = new.media_id;
+end;
+
+insert into media_search (rowid, name, artist, album, title, genre)
+select id, name, artist, album,
+  (select value from media_info where media_id = media.id and name = 'title'),
+  (select value from media_info where media_id = media.id and name = 'genre')
+from media;
+"""
+
+    # Number of items inserted per transaction by insert_many
+    COMMIT_SIZE = 1000
+    # Page cache size in KiB used during bulk loads
+    BULK_CACHE_SIZE = 64 * 1024
+
+    # Number of prepared statements cached per connection
+    CACHED_STATEMENTS = 100
+    # Sortable columns, mapped to the indexed columns used for ordering
+    SORT_KEYS = {
+        'name': ('name', 'id'),
+        'artist': ('artist', 'album', 'name', 'id'),
+        'album': ('album', 'name', 'id'),
+    }
+    # Number of rows fetched at a time by iter_query
+    FETCH_SIZE = 500
+    # Maximum number of ids bound in one property query
+    PROPS_CHUNK_SIZE = 500
+    # Default and maximum number of items per page
+    PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+
+    def __init__(self, db_file=config.DB_FILE, read_only=False, pooled=False):
+        """If pooled is set, the connection is kept open when the library
+        is closed and reused by the next pooled library on the same thread.
+        Read only libraries reject any writes.
+        """
         super(MediaLibrary, self).__init__()
         self.db_file = db_file
+        self.read_only = read_only
+        self.pooled = pooled
         self.conn = None
 
     def connect(self):
+        if self.pooled:
+            pool = _thread_connections.__dict__.setdefault('pool', {})
+            self.conn = pool.get((self.db_file, self.read_only))
+            if self.conn is not None:
+                return
         schema_required = (not os.path.exists(self.db_file))
         try:
-            self.conn = sqlite3.connect(self.db_file)
+            self.conn = sqlite3.connect(self.db_file, cached_statements=self.CACHED_STATEMENTS)
         except Exception as e:
             self.logger.error(
                 'Failed to connect to the database at %s: %s' % (self.db_file, str(e))
             )
             raise e
+        # Fire the delete trigger for rows removed by 'on conflict replace'
+        self.conn.execute("PRAGMA recursive_triggers = ON")
         if schema_required:
             self._create_schema()
-
-    def _get_max_id(self, cursor):
-        cursor.execute("SELECT MAX(id) FROM media")
-        res = cursor.fetchone()[0]
-        if res is not None:
-            return res
-        return 0
+        self._migrate()
+        if not self.read_only:
+            self._create_search_index()
+        if self.pooled:
+            # Let readers on other threads proceed while a write is in progress
+            self.conn.execute("PRAGMA journal_mode = WAL")
+            pool[(self.db_file, self.read_only)] = self.conn
+        if self.read_only:
+            self.conn.execute("PRAGMA query_only = ON")
 
     def save(self):
         """Commits any current transaction."""
         self.conn.commit()
 
+    @contextmanager
+    def bulk_load(self):
+        """Context manager tuning the connection for a large number
+        of inserts. Switches the database to WAL mode and relaxes
+        syncing until the load is complete.
+        """
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("PRAGMA temp_store = MEMORY")
+        self.conn.execute("PRAGMA cache_size = -%i" % self.BULK_CACHE_SIZE)
+        try:
+            yield self
+        finally:
+            self.conn.execute("PRAGMA synchronous = FULL")
+            self.conn.execute("PRAGMA cache_size = -2000")
+
+    def insert(self, name, path, length, size, mime_type=None, props=None, ignore_duplicates=False,
+               mtime=None, inode=None, **stream_info):
+        """Inserts an item. The optional keyword arguments 'duration',
+        'codec', 'bitrate', 'sample_rate' and 'channels' describe the
+        audio stream.
+        """
+        item = {
+            'name': name, 'path': path, 'length': length, 'size': size,
+            'mime_type': mime_type, 'props': props, 'mtime': mtime, 'inode': inode
+        }
+        item.update(stream_info)
+        self.insert_many([item], ignore_duplicates, commit=False)
+
     @with_rollback
-    def insert(self, name, path, length, size, mime_type=None, props=None, ignore_duplicates=False):
+    def insert_many(self, items, ignore_duplicates=False, commit=True):
+        """Inserts the items from an iterable of dicts, with the keys
+        'name', 'path', 'length', 'size' and optionally 'mime_type',
+        'props', 'mtime', 'inode', 'duration', 'codec', 'bitrate',
+        'sample_rate' and 'channels'. Commits after every COMMIT_SIZE
+        items unless commit is False.
+        Returns the number of items inserted.
+        """
         cursor = self.conn.cursor()
-        insert_id = self._get_max_id(cursor) + 1
-        params = {'name': name, 'path': path, 'length': length,
-                  'size': size, 'mimetype': mime_type}
-        try:
-            cursor.execute(
-                """INSERT INTO media ("name", "path", "length", "size", "mime_type")
-                VALUES (:name, :path, :length, :size, :mimetype)""",
-                params
-            )
-            if props is not None:
-                for name, value in props.items():
-                    cursor.execute("""INSERT INTO media_info VALUES (:id, :name, :value)""",
-                                   {'id': insert_id, 'name': name, 'value': value})
-        except sqlite3.IntegrityError as e:
-            if not ignore_duplicates:
-                raise e
+        count = 0
+        info_rows = []
+        for item in items:
+            params = {'mime_type': None, 'props': None, 'mtime': None, 'inode': None,
+                      'duration': None, 'codec': None, 'bitrate': None, 'sample_rate': None,
+                      'channels': None}
+            params.update(item)
+            props = params['props'] or {}
+            params['artist'] = props.get('artist', '')
+            params['album'] = props.get('album', '')
+            try:
+                cursor.execute(
+                    """INSERT INTO media ("name", "path", "length", "size", "mime_type", "mtime", "inode",
+                                          "artist", "album", "duration", "codec", "bitrate",
+                                          "sample_rate", "channels")
+                    VALUES (:name, :path, :length, :size, :mime_type, :mtime, :inode,
+                            :artist, :album, :duration, :codec, :bitrate,
+                            :sample_rate, :channels)""",
+                    params
+                )
+            except sqlite3.IntegrityError as e:
+                if not ignore_duplicates:
+                    raise e
+                continue
+            if params['props'] is not None:
+                media_id = cursor.lastrowid
+                info_rows.extend((media_id, name, value) for name, value in params['props'].items())
+            count += 1
+            if commit and count % self.COMMIT_SIZE == 0:
+                self._insert_info(cursor, info_rows)
+                info_rows = []
+                self.conn.commit()
+        self._insert_info(cursor, info_rows)
+        if commit:
+            self.conn.commit()
+        return count
+
+    def _insert_info(self, cursor, info_rows):
+        cursor.executemany("""INSERT INTO media_info VALUES (?, ?, ?)""", info_rows)
+
+    @with_rollback
+    def delete_paths(self, paths):
+        """Deletes the items with the given paths"""
+        self.conn.executemany("""DELETE FROM media WHERE path=?""", ((path,) for path in paths))
+
+    def get_signatures(self, root):
+        """Returns a dict mapping the path of each item under the
+        given root directory to its (size, mtime, inode) signature.
+        """
+        prefix = os.path.join(root, '')
+        cursor = self.conn.cursor()
+        cursor.execute("""SELECT path, size, mtime, inode FROM media
+                       WHERE substr(path, 1, :len)=:prefix""",
+                       {'len': len(prefix), 'prefix': prefix})
+        signatures = {}
+        for path, size, mtime, inode in cursor:
+            signatures[path] = (size, mtime, inode)
+        return signatures
+
+    def get_ids(self, paths):
+        """Returns a dict mapping each of the paths in the library to its item id"""
+        cursor = self.conn.cursor()
+        ids = {}
+        for path in paths:
+            cursor.execute("""SELECT id FROM media WHERE path=?""", (path,))
+            row = cursor.fetchone()
+            if row is not None:
+                ids[path] = row[0]
+        return ids
+
+    @with_rollback
+    def add_root(self, path):
+        """Records a directory scanned by the media discovery"""
+        self.conn.execute("""INSERT OR IGNORE INTO media_root VALUES (:path)""", {'path': path})
+
+    def get_roots(self):
+        """Returns the directories scanned by the media discovery"""
+        cursor = self.conn.cursor()
+        cursor.execute("""SELECT path FROM media_root""")
+        return [path for path, in cursor.fetchall()]
 
     def get_all(self):
+        return list(self.iter_all())
+
+    def iter_all(self, with_props=False):
+        """Generator over all items in the library"""
+        return self.iter_query(with_props=with_props)
+
+    def iter_query(self, condition=None, params=(), order_by=None, with_props=False):
+        """Generator over the items matching the SQL condition, fetching
+        FETCH_SIZE rows at a time so memory use does not grow with the
+        size of the library. The item properties are loaded for each
+        batch of rows if with_props is set.
+        """
+        query = "SELECT %s FROM media" % _ITEM_COLUMNS
+        if condition is not None:
+            query += " WHERE " + condition
+        if order_by is not None:
+            query += " ORDER BY " + order_by
         cursor = self.conn.cursor()
-        cursor.execute("""SELECT id, name, path, length, size, mime_type FROM media""")
-        items = []
-        for row in cursor.fetchall():
-            items.append(MediaItem(*row, library=self))
-        return items
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(self.FETCH_SIZE)
+            if len(rows) == 0:
+                break
+            items = [MediaItem(*row) for row in rows]
+            if with_props:
+                self.load_props(items)
+            for item in items:
+                yield item
 
     def get_item(self, media_id):
         cursor = self.conn.cursor()
-        cursor.execute("""SELECT id, name, path, length, size, mime_type FROM media
-                       WHERE id=:id""", {'id': media_id})
+        cursor.execute("""SELECT %s FROM media WHERE id=:id""" % _ITEM_COLUMNS, {'id': media_id})
         res = cursor.fetchone()
         if res is not None:
-            return MediaItem(*res, library=self)
+            item = MediaItem(*res)
+            self.load_props([item])
+            return item
         return None
 
-    def _get_props(self, media_id):
-        if self.conn is None:
-            self.connect()
+    def get_page(self, sort='name', after=None, limit=None, descending=False, with_props=False):
+        """Gets a page of items ordered by the given sort key, starting
+        after the position given by the cursor returned with the previous
+        page. Returns a tuple of the items and the cursor for the next page,
+        which is None on the last page. The item properties are loaded
+        if with_props is set.
+        Raises ValueError for an unknown sort key or invalid cursor.
+        """
+        if sort not in self.SORT_KEYS:
+            raise ValueError("Cannot sort by %s" % sort)
+        keys = self.SORT_KEYS[sort]
+        limit = self._page_limit(limit)
+        order = ' DESC' if descending else ''
+        query = "SELECT %s FROM media" % _ITEM_COLUMNS
+        params = []
+        if after is not None:
+            values = self._decode_cursor(after, len(keys))
+            where, params = self._keyset_condition(keys, values, '<' if descending else '>')
+            query += " WHERE " + where
+        query += " ORDER BY %s LIMIT ?" % ', '.join(key + order for key in keys)
+        params.append(limit + 1)
+        cursor = self.conn.cursor()
+        cursor.execute(query, params)
+        items = [MediaItem(*row) for row in cursor.fetchall()]
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            next_cursor = self._encode_cursor([getattr(items[-1], key) for key in keys])
+        if with_props:
+            self.load_props(items)
+        return items, next_cursor
+
+    def get_following(self, item, sort='name', limit=None, descending=False):
+        """Gets up to limit items following the item in the given sort
+        order, as listed by get_page.
+        Raises ValueError for an unknown sort key.
+        """
+        if sort not in self.SORT_KEYS:
+            raise ValueError("Cannot sort by %s" % sort)
+        cursor = self._encode_cursor([getattr(item, key) for key in self.SORT_KEYS[sort]])
+        return self.get_page(sort, cursor, limit, descending)[0]
+
+    @staticmethod
+    def _keyset_condition(keys, values, op):
+        """Builds the condition selecting rows positioned after the
+        given sort key values. The leading comparison on the first key
+        lets sqlite seek on the index.
+        """
+        terms = []
+        params = [values[0]]
+        for i in range(len(keys)):
+            term = ["%s = ?" % key for key in keys[:i]] + ["%s %s ?" % (keys[i], op)]
+            terms.append("(%s)" % " AND ".join(term))
+            params.extend(values[:i + 1])
+        return "%s %s= ? AND (%s)" % (keys[0], op, " OR ".join(terms)), params
+
+    @staticmethod
+    def _encode_cursor(values):
+        return base64.urlsafe_b64encode(json.dumps(values))
+
+    @staticmethod
+    def _decode_cursor(cursor, num_values):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        except (TypeError, ValueError):
+            raise ValueError("Invalid cursor")
+        if not isinstance(values, list) or len(values) != num_values:
+            raise ValueError("Invalid cursor")
+        # The sort keys are all strings or numbers, anything else cannot be bound
+        if not all(isinstance(value, (basestring, int, long, float)) for value in values):
+            raise ValueError("Invalid cursor")
+        return values
+
+    def _page_limit(self, limit):
+        """Returns the number of items to fetch for the requested limit,
+        PAGE_SIZE if not given, and between 1 and MAX_PAGE_SIZE
+        """
+        return max(1, min(limit or self.PAGE_SIZE, self.MAX_PAGE_SIZE))
+
+    def search(self, text, limit=None, with_props=False):
+        """Searches the item names and tags for words starting with
+        each of the words in text. Returns the matching items, best
+        matches first.
+        """
+        terms = [term.replace('"', '') for term in text.split()]
+        terms = [term for term in terms if term]
+        if len(terms) == 0:
+            return []
+        limit = self._page_limit(limit)
+        cursor = self.conn.cursor()
+        if self._has_search_index():
+            cursor.execute(
+                """SELECT %s FROM media_search JOIN media ON media.id = media_search.rowid
+                WHERE media_search MATCH ? ORDER BY rank LIMIT ?""" % _ITEM_COLUMNS,
+                (' '.join('"%s"*' % term for term in terms), limit)
+            )
+        else:
+            # Without FTS5 fall back to scanning for each term
+            condition = " AND ".join(["(name LIKE ? OR artist LIKE ? OR album LIKE ?)"] * len(terms))
+            params = []
+            for term in terms:
+                params.extend(['%' + term + '%'] * 3)
+            cursor.execute(
+                """SELECT %s FROM media WHERE %s ORDER BY name LIMIT ?""" % (_ITEM_COLUMNS, condition),
+                params + [limit]
+            )
+        items = [MediaItem(*row) for row in cursor.fetchall()]
+        if with_props:
+            self.load_props(items)
+        return items
+
+    def _has_search_index(self):
         cursor = self.conn.cursor()
-        cursor.execute("""SELECT name, value FROM media_info WHERE id=:id""", {'id': media_id})
+        cursor.execute("""SELECT 1 FROM sqlite_master WHERE name = 'media_search'""")
+        return cursor.fetchone() is not None
+
+    def _create_search_index(self):
+        """Creates and populates the full text search index,
+        if FTS5 is available and the index does not exist yet
+        """
+        if self._has_search_index():
+            return
+        cursor = self.conn.cursor()
+        cursor.execute("PRAGMA compile_options")
+        if 'ENABLE_FTS5' not in [option for option, in cursor.fetchall()]:
+            self.logger.warning("FTS5 is not available, search will be slow")
+            return
+        self.logger.info("Creating search index")
+        try:
+            cursor.executescript("BEGIN;\n%sCOMMIT;" % self.__SEARCH_SCHEMA)
+        except Exception as e:
+            self.logger.error("Failed to create the search index: %s" % str(e))
+            self.conn.rollback()
+            raise e
+
+    def load_props(self, items):
+        """Loads the properties for all of the given items"""
+        props = self.get_props([item.id for item in items])
+        for item in items:
+            item.props = props.get(item.id, {})
+
+    def get_props(self, media_ids):
+        """Gets the properties for the given item ids, with one query
+        per PROPS_CHUNK_SIZE ids. Returns a dict of property dicts keyed
+        by item id.
+        """
         props = {}
-        for name, value in cursor.fetchall():
-            props[name] = value
+        cursor = self.conn.cursor()
+        for start in range(0, len(media_ids), self.PROPS_CHUNK_SIZE):
+            chunk = media_ids[start:start + self.PROPS_CHUNK_SIZE]
+            cursor.execute(
+                """SELECT media_id, name, value FROM media_info WHERE media_id IN (%s)"""
+                % ', '.join('?' * len(chunk)), chunk
+            )
+            for media_id, name, value in cursor:
+                props.setdefault(media_id, {})[name] = value
         return props
 
     def _create_schema(self):
@@ -144,10 +561,29 @@ create table media_info (
             self.logger.error("Failed to create the database schema: %s" % str(e))
             raise e
 
+    def _migrate(self):
+        """Applies any outstanding schema upgrades"""
+        cursor = self.conn.cursor()
+        cursor.execute("PRAGMA user_version")
+        version = cursor.fetchone()[0]
+        for version, script in enumerate(self.__MIGRATIONS[version:], version + 1):
+            self.logger.info("Upgrading database schema to version %s" % version)
+            try:
+                cursor.executescript(
+                    "BEGIN;\n%sPRAGMA user_version = %i;\nCOMMIT;" % (script, version)
+                )
+            except Exception as e:
+                self.logger.error("Failed to upgrade the database schema: %s" % str(e))
+                self.conn.rollback()
+                raise e
+
     def __enter__(self):
         self.connect()
         return self
 
     def __exit__(self, *_):
-        self.conn.close()
+        if self.pooled:
+            self.conn.rollback()  # Discard any uncommitted changes, as closing would
+        else:
+            self.conn.close()
         self.conn = None
@@ -0,0 +1,47 @@
+from config import ComponentBase
+
+__all__ = ["TranscodeProfile"]
+
+
+class TranscodeProfile(ComponentBase):
+    """Output settings for cached transcodes. Each profile is configured
+    in the app.ini section [profile:<name>]. Profiles are cached under
+    '<container>.<name>', so each profile has its own cache entries, apart
+    from the live transcodes cached under the container name.
+    """
+
+    DEFAULT = 'default'
+
+    CODEC = 'libvorbis'
+    CONTAINER = 'webm'
+    QUALITY = '4'  # Codec specific quality, used if BITRATE is not set
+    BITRATE = 0  # kbps, or 0 to use QUALITY
+    SAMPLE_RATE = 0  # Hz, or 0 to keep the source sample rate
+    CHANNELS = 0  # Or 0 to keep the source channels
+    THREADS = 0  # ffmpeg threads, or 0 to let ffmpeg choose
+
+    def __init__(self, name, **defaults):
+        """Settings in defaults override the class defaults, and are
+        overridden by the profile's config section
+        """
+        super(TranscodeProfile, self).__init__()
+        self.name = name
+        for key, value in defaults.iteritems():
+            setattr(self, key.upper(), value)
+        self._load_config('profile:%s' % name)
+        self.file_format = '%s.%s' % (self.CONTAINER, name)
+
+    def get_options(self):
+        """Returns the ffmpeg output options for the profile"""
+        options = ['-acodec', self.CODEC]
+        if self.BITRATE:
+            options.extend(['-b:a', '%ik' % self.BITRATE])
+        else:
+            options.extend(['-aq', self.QUALITY])
+        if self.SAMPLE_RATE:
+            options.extend(['-ar', str(self.SAMPLE_RATE)])
+        if self.CHANNELS:
+            options.extend(['-ac', str(self.CHANNELS)])
+        if self.THREADS:
+            options.extend(['-threads', str(self.THREADS)])
+        return options
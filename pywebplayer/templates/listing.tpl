@@ -5,16 +5,29 @@
 </head>
 <body>
 <h1>{{listing_title}}</h1>
+<form action='/search'>
+  <input type='search' name='q' placeholder='Search'>
+</form>
 <table>
   <thead>
-    <th>Name</th><th>Length</th>
+    <th></th>
+    <th><a href='/?sort=name'>Name</a></th>
+    <th><a href='/?sort=artist'>Artist</a></th>
+    <th><a href='/?sort=album'>Album</a></th>
+    <th>Length</th>
   </thead>
-%for id, name, length in items:
+%for id, name, artist, album, length in items:
   <tr>
-    <td><a href='/player/{{id}}'>{{name}}</a></td>
+    <td><img src='/art/item/{{id}}?size=64' width='64' height='64' alt='' loading='lazy'></td>
+    <td><a href='/player/{{id}}{{player_query}}'>{{name}}</a></td>
+    <td>{{artist}}</td>
+    <td>{{album}}</td>
     <td>{{length}}</td>
   </tr>
 %end
 </table>
+%if next_url:
+<p><a href='{{next_url}}'>Next</a></p>
+%end
 </body>
 </html>
@@ -6,7 +6,7 @@
 <body>
 <h1>Media Player</h1>
 <p>{{name}}</p>
-<audio src='/stream/{{id}}' controls>
+<audio src='/stream/{{id}}{{stream_query}}' controls>
 </audio>
 </body>
 </html>
@@ -1,9 +1,16 @@
 import subprocess
 import os
-import re
-import tempfile
-from Queue import Queue, Empty
+import json
+import math
+import itertools
+import threading
+from collections import OrderedDict
 from config import ComponentBase, config
+from jobs import TranscodeJob, JobRegistry, TranscodeScheduler
+from cache import TranscodeCache
+from art import AlbumArtCache
+from profiles import TranscodeProfile
+from tags import read_media_info
 
 
 class Transcoder(ComponentBase):
@@ -11,10 +18,46 @@ class Transcoder(ComponentBase):
     Manages a cache of transcoded items.
     """
 
+    # Settings of the default output profile, see TranscodeProfile
     AUDIO_CODEC = 'libvorbis'
     AUDIO_CONTAINER = 'webm'
     AUDIO_QUALITY = '4'
+    # Output profiles for cached transcodes, in order of preference.
+    # Profiles other than the default are configured in [profile:<name>]
+    PROFILES = 'default'
+    # Profile used for clients which send Save-Data, if set
+    SAVE_DATA_PROFILE = ''
     BUF_SIZE = 4096
+    # Live streaming containers, in order of preference. Wav is used
+    # only if the client supports none of these.
+    LIVE_FORMATS = 'webm,ogg'
+    LIVE_CODEC = 'libopus'
+    LIVE_FRAME_DURATION = '20'  # Opus frame size in milliseconds
+    # Live bitrate tiers in kbps, only the highest tier is cached
+    LIVE_BITRATES = '48,96,160'
+    # Number of negotiated Accept header results kept
+    NEGOTIATION_CACHE_SIZE = 256
+    # Read media info from the file headers where possible, rather than ffprobe
+    NATIVE_TAGS = True
+    # Fixed format of the wav streams, so byte offsets can be mapped to times
+    WAV_SAMPLE_RATE = 44100
+    WAV_CHANNELS = 2
+    WAV_SAMPLE_SIZE = 2
+    WAV_HEADER_SIZE = 44
+    # Segmented (HLS) output, each segment is transcoded and cached separately
+    SEGMENT_DURATION = 10  # Seconds
+    SEGMENT_CODEC = 'aac'
+    SEGMENT_BITRATE = '192k'
+    SEGMENT_EXT = 'ts'
+    SEGMENT_TYPE = 'video/mp2t'
+    PLAYLIST_TYPE = 'application/vnd.apple.mpegurl'
+    # Number of segments transcoded ahead of the one requested
+    SEGMENT_LOOKAHEAD = 3
+    # Number of following items transcoded in the background when an item is played
+    PREFETCH_DEPTH = 3
+    # Fraction of the cache which may be filled by prefetched transcodes
+    # which have not been played
+    PREFETCH_CACHE_SHARE = 0.8
     MIME_MAP = {
       'mp3': 'audio/mp3',
       'ogg': 'audio/ogg',
@@ -26,121 +69,429 @@ class Transcoder(ComponentBase):
       'wav': 'audio/wav'
     }
 
+    # ffmpeg output format options of the containers whose muxer has
+    # another name, or which need options to be written to a pipe
+    __MUXER_OPTIONS = {
+        'm4a': ['-f', 'ipod', '-movflags', 'frag_keyframe+empty_moov'],
+        'mp4': ['-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov'],
+        'aac': ['-f', 'adts'],
+    }
+
+    # Output options for remuxing cached files of containers whose index
+    # and duration are only written to seekable output
+    __REMUX_OPTIONS = {
+        'webm': ['-f', 'webm'],
+        'matroska': ['-f', 'matroska'],
+        'm4a': ['-f', 'ipod', '-movflags', '+faststart'],
+        'mp4': ['-f', 'mp4', '-movflags', '+faststart'],
+    }
+
+    # Muxer options to write live output in small chunks
+    __LIVE_MUXER_OPTIONS = {
+        'webm': ['-cluster_time_limit', '500'],  # Milliseconds
+        'ogg': ['-page_duration', '100000'],  # Microseconds
+    }
+
     def __init__(self):
         super(Transcoder, self).__init__()
         self._load_config()
-        # TODO - Handle caching in a separate class
-        self.transcode_cache = {}
-        self._load_cached_items()
-        # Regex's for parsing file metadata from ffmpeg / ffprobe
-        # TODO - Use XML / JSON output from ffprobe
-        self.metadata_re = re.compile(r'\s+([a-zA-Z]+)\s+: (.+)')
-        self.metadata_start_re = re.compile(r'\s+Metadata:')
-        self.duration_re = re.compile(r'\s+(Duration): ([0-9:]+)')
-        self.process_queue = Queue()  # Queue to hold any background ffmpeg processes
-
-    def _load_cached_items(self):
-        """Load the existing cached files."""
-        count = 0
-        for entry in os.listdir(config.CACHE_DIR):
-            name, ext = os.path.splitext(entry)
-            if name.isdigit():
-                count += 1
-                self.add_cached_file(int(name), os.path.join(config.CACHE_DIR, entry), ext[1:])
-        self.logger.info("Found %s existing items in the cache" % count)
-
-    def get_output_type(self, item, accept_types, background=False):
-        """Get the best available output type based
-        on the item type and user-agent accept types.
-        Returns None if the browser does not support any of the
-        audio formats.
-        """
-        # TODO - Handle case where accept contains only '*/*'
-        accept_type_names = [val.split(';') for val in accept_types]
-        if item.mime_type in accept_type_names:
-            # TODO - Use item.available instead of cached
-            item.cached = True
-            return item.mime_type
-        else:
-            cached_item = self.transcode_cache.get(item.id)
-            if cached_item is not None:
+        self._cache = None
+        self._art = None
+        self.active_jobs = JobRegistry()  # In progress transcode jobs
+        self.scheduler = TranscodeScheduler()
+        self._seek_ids = itertools.count()
+        self._live_types = [
+            self.MIME_MAP[container.strip()] for container in self.LIVE_FORMATS.split(',')
+        ] + [self.MIME_MAP['wav']]
+        self.profiles = self._load_profiles()
+        # Cached formats of each type, plain containers before the profiles
+        self._cached_formats = self.MIME_MAP.items() + [
+            (profile.file_format, profile.mime_type) for profile in self.profiles.values()
+        ]
+        self._format_matrix = self._get_format_matrix()
+        self._negotiated = OrderedDict()  # Keyed by (accept, mime_type)
+        self._negotiation_lock = threading.Lock()
+
+    @property
+    def cache(self):
+        """The transcode cache, opened on first use"""
+        if self._cache is None:
+            self._cache = TranscodeCache()
+        return self._cache
+
+    def _load_profiles(self):
+        """Returns an OrderedDict of the configured profiles by name. The
+        default profile is always included, using the AUDIO_* settings
+        unless overridden in its own section.
+        """
+        profiles = OrderedDict()
+        names = [name.strip() for name in self.PROFILES.split(',') if name.strip()]
+        if TranscodeProfile.DEFAULT not in names:
+            names.append(TranscodeProfile.DEFAULT)
+        for name in names:
+            defaults = {}
+            if name == TranscodeProfile.DEFAULT:
+                defaults = {'codec': self.AUDIO_CODEC, 'container': self.AUDIO_CONTAINER,
+                            'quality': self.AUDIO_QUALITY}
+            profile = TranscodeProfile(name, **defaults)
+            if profile.CONTAINER not in self.MIME_MAP:
+                self.logger.warning(
+                    "Ignoring profile %s, unknown container %s" % (name, profile.CONTAINER)
+                )
+                continue
+            profile.mime_type = self.MIME_MAP[profile.CONTAINER]
+            profiles[name] = profile
+        return profiles
+
+    def get_profile(self, accept=None, name=None):
+        """Returns the named profile, raising KeyError if there is no such
+        profile. Otherwise returns the first profile whose type is accepted
+        by the Accept header, or the default profile.
+        """
+        if name is not None:
+            return self.profiles[name]
+        if accept is not None:
+            profile = self.get_accepted_profile(accept)
+            if profile is not None:
+                return profile
+        return self.profiles[TranscodeProfile.DEFAULT]
+
+    def get_accepted_profile(self, accept):
+        """Returns the first profile whose type is accepted by the Accept
+        header, or None if none are
+        """
+        accepted = self._parse_accept(accept)
+        for profile in self.profiles.values():
+            if self._quality(accepted, profile.mime_type) > 0:
+                return profile
+        return None
+
+    def get_output_type(self, item, accept, background=False, bitrate=None):
+        """Get the best available output type based on the item type
+        and the user-agent Accept header. The original file is sent if it
+        is accepted, followed by any accepted cached format. Otherwise the
+        item is transcoded live to the accepted live format with the
+        highest q-value, or to wav. Background transcodes use the
+        type of the accepted profile. If bitrate is a reduced live bitrate
+        the item is always transcoded live.
+        """
+        output_types = self.negotiate(accept, item.mime_type)
+        if bitrate is None or not self.is_reduced_bitrate(bitrate):
+            if item.mime_type in output_types:
+                # TODO - Use item.available instead of cached
                 item.cached = True
-                for container in cached_item:
-                    return self.MIME_MAP[container]
-            else:
-                if background:
-                    return self.MIME_MAP[self.AUDIO_CONTAINER]
-                return self.MIME_MAP['wav']
+                return item.mime_type
+            cached_types = self._get_cached_types(item.id)
+            for output_type in output_types:
+                if output_type in cached_types:
+                    item.cached = True
+                    return output_type
+        if background:
+            return self.get_profile(accept).mime_type
+        for output_type in output_types:
+            if output_type in self._live_types:
+                return output_type
+        return self.MIME_MAP['wav']
 
-    def check_background_processes(self):
-        """Check on any ffmpeg processes running in the background"""
-        running_items = []
-        try:
-            while True:
-                proc, tmp, media_id, out_file = self.process_queue.get_nowait()
-                proc.poll()
-                if proc.returncode is None:
-                    running_items.append((proc, tmp, media_id, out_file))
-                else:
-                    self._on_ffmpeg_complete(proc, tmp.name, media_id, out_file)
-        except Empty:
-            # Put any processes still running back on the queue
-            for item in running_items:
-                self.process_queue.put(item)
-        return len(running_items) > 0
+    def get_cached_format(self, media_id, mime_type):
+        """Returns the format the item is cached in as mime_type, or None
+        if it is not cached in that type. The live or original container
+        is preferred, followed by the profiles in order.
+        """
+        return self._get_cached_types(media_id).get(mime_type)
+
+    def _get_cached_types(self, media_id):
+        """Returns a dict mapping the types the item is cached in to
+        their preferred cached format
+        """
+        formats = set(self.cache.formats(media_id))
+        cached_types = {}
+        for file_format, mime_type in self._cached_formats:
+            if file_format in formats:
+                cached_types.setdefault(mime_type, file_format)
+        return cached_types
+
+    def negotiate(self, accept, mime_type):
+        """Returns the types an item of mime_type can be sent as which
+        are accepted by the Accept header, in order of q-value. Results are
+        cached per Accept header and mime type.
+        """
+        key = (accept, mime_type)
+        with self._negotiation_lock:
+            output_types = self._negotiated.pop(key, None)
+            if output_types is None:
+                accepted = self._parse_accept(accept)
+                candidates = self._format_matrix.get(mime_type)
+                if candidates is None:
+                    candidates = [mime_type] + self._format_matrix[None]
+                qualities = [(self._quality(accepted, output_type), output_type)
+                             for output_type in candidates]
+                # Sorting is stable, so equal q-values keep the matrix order
+                output_types = [output_type for q, output_type in
+                                sorted(qualities, key=lambda entry: -entry[0]) if q > 0]
+            self._negotiated[key] = output_types
+            if len(self._negotiated) > self.NEGOTIATION_CACHE_SIZE:
+                self._negotiated.popitem(last=False)
+            return output_types
+
+    def _get_format_matrix(self):
+        """Returns a dict mapping each source mime type to the types it
+        can be sent as, in order of preference: the original type, then
+        the transcoded types. The None key holds only the transcoded types.
+        """
+        transcoded = []
+        profile_types = [profile.mime_type for profile in self.profiles.values()]
+        for output_type in profile_types + self._live_types:
+            if output_type not in transcoded:
+                transcoded.append(output_type)
+        matrix = {None: transcoded}
+        for mime_type in self.MIME_MAP.values():
+            matrix[mime_type] = [mime_type] + [
+                output_type for output_type in transcoded if output_type != mime_type
+            ]
+        return matrix
+
+    @staticmethod
+    def _parse_accept(accept):
+        """Parses an Accept header into a dict of media range to q-value.
+        A missing or empty header accepts any type.
+        """
+        accepted = {}
+        for value in (accept or '').split(','):
+            params = value.split(';')
+            media_range = params[0].strip().lower()
+            if not media_range:
+                continue
+            q = 1.0
+            for param in params[1:]:
+                name, _, q_value = param.partition('=')
+                if name.strip().lower() == 'q':
+                    try:
+                        q = float(q_value)
+                    except ValueError:
+                        q = 0.0
+            accepted[media_range] = q
+        if len(accepted) == 0:
+            accepted['*/*'] = 1.0
+        return accepted
+
+    @staticmethod
+    def _quality(accepted, mime_type):
+        """Returns the q-value of the most specific media range matching mime_type"""
+        for media_range in (mime_type, mime_type.split('/')[0] + '/*', '*/*'):
+            if media_range in accepted:
+                return accepted[media_range]
+        return 0.0
+
+    def get_live_bitrate(self, max_bitrate=None):
+        """Returns the highest live bitrate tier within max_bitrate kbps,
+        or the lowest tier if none are
+        """
+        tiers = self._live_bitrates()
+        if max_bitrate is None:
+            return tiers[-1]
+        within = [tier for tier in tiers if tier <= max_bitrate]
+        return within[-1] if len(within) > 0 else tiers[0]
+
+    def is_reduced_bitrate(self, bitrate):
+        """Returns True if bitrate is below the highest live bitrate tier"""
+        return bitrate < self._live_bitrates()[-1]
+
+    def _live_bitrates(self):
+        return sorted(int(tier) for tier in self.LIVE_BITRATES.split(','))
+
+    @property
+    def art(self):
+        """The album art cache, opened on first use"""
+        if self._art is None:
+            self._art = AlbumArtCache()
+        return self._art
 
     def get_album_art(self, path, artist, album):
         """Get the album art for the given path and store to the album
-        art cache. Extracts from the audio file if possible.
+        art cache. Extracts from the audio file if possible. The art is
+        only looked up once per album. Returns the hash identifying the
+        art in the cache, or None if the album has no art.
         """
-        # TODO
-        pass
+        return self.art.get(path, artist, album)
 
-    def start_transcode(self, path, media_id, background=False):
-        """Transcode the audio to ogg vorbis only for
-        now. Uses ffmpeg to perform the transcode.
-        Returns a generator for reading the buffered data.
+    def start_transcode(self, path, media_id, background=False, container='wav', bitrate=None,
+                        profile=None):
+        """Transcode the audio using ffmpeg. Background transcodes, and
+        transcodes with a profile, use the given or default profile and
+        are cached in its format. Live transcodes for streaming use
+        the given container, and bitrate in kbps or the highest live
+        bitrate, and are run ahead of background jobs. Live transcodes
+        are cached only at the highest bitrate and never as wav.
+        Returns the TranscodeJob, which can be streamed while the
+        transcode is queued or in progress. Concurrent calls for the same
+        item and format share a single job.
         """
-        # Send stderr to a temporary file for later reading
-        tmp = tempfile.NamedTemporaryFile()
-        codec = self.AUDIO_CODEC
-        container = self.AUDIO_CONTAINER
-        if not background:  # Use wav format when streaming for low latency
+        file_format = container
+        cached = True
+        priority = TranscodeScheduler.INTERACTIVE
+        if background or profile is not None:
+            profile = profile or self.get_profile()
+            codec = profile.CODEC
+            container = profile.CONTAINER
+            file_format = profile.file_format
+            bitrate = None
+            if background:
+                priority = TranscodeScheduler.BACKGROUND
+        elif container == 'wav':
             codec = 'pcm_s16le'
-            container = 'wav'
-        cache_file_name = self._get_cache_file_name(media_id, container)
-        proc = self._start_ffmpeg(path, tmp, cache_file_name, codec, container)
-        if True:
-            self.process_queue.put((proc, tmp, media_id, cache_file_name))
-            return proc
+            bitrate = None
+            cached = False
         else:
-            return self._stream_generator(proc, tmp, cache_file_name, media_id)
-
-    def _stream_generator(self, proc, tmp, cache_file_name, media_id):
-        """Generator for streaming the output of the ffmpeg process"""
-        # TODO - Find a way to enable seeking when streaming ffmpeg output.
-        # Currently not possible, since ffmpeg does not set the file duration when piping
-        cache_file = open(cache_file_name, 'w')
-        terminated = False
-        buf = bytes()
-        try:
-            try:
-                while proc.returncode is None:
-                    try:
-                        buf = proc.stdout.read(self.BUF_SIZE)
-                        cache_file.write(buf)
-                        yield buf
-                        proc.poll()  # Check return status
-                    except IOError as e:  # Handle client closing the connection
-                        proc.terminate()
-                        terminated = True  # Return will be non-zero if we terminated
-                        self.logger.warning(str(e))
-            finally:
-                cache_file.close()
-            self._on_ffmpeg_complete(proc, tmp.name, media_id, cache_file_name, terminated)
-        finally:
-            tmp.close()
-        raise StopIteration
+            codec = self.LIVE_CODEC
+            bitrate = bitrate or self.get_live_bitrate()
+            if self.is_reduced_bitrate(bitrate):
+                file_format = '%s.%ik' % (container, bitrate)
+                cached = False
+        job = self.active_jobs.get_or_start(
+            media_id, file_format,
+            lambda: self._start_ffmpeg(
+                path, media_id, codec, container, file_format, priority, cached, bitrate, profile
+            )
+        )
+        self.scheduler.prioritise(job, priority)
+        return job
+
+    def start_seek_transcode(self, path, media_id, start, raw=False):
+        """Transcode the audio to wav from start seconds into the file,
+        for seeking within an item which is not cached. The output is
+        only streamed, not cached. If raw is set, the output is headerless
+        PCM, continuing the byte stream of a full wav transcode.
+        Returns the TranscodeJob.
+        """
+        container = 's16le' if raw else 'wav'
+        self.logger.info("Queueing transcode for %s from %ss" % (path, start))
+        job = TranscodeJob(
+            self._get_ffmpeg_command(path, 'pcm_s16le', container, start), None,
+            self.cache.get_partial_file_name(media_id, 'seek%i' % next(self._seek_ids)),
+            media_id, container, self._on_ffmpeg_complete
+        )
+        return self.scheduler.submit(job, TranscodeScheduler.INTERACTIVE)
+
+    def wav_offset_to_time(self, offset):
+        """Maps a byte offset in a wav stream to the time in seconds of the
+        sample it falls within. Returns a tuple of the time and the number of
+        bytes into that sample.
+        """
+        frame_size = self.WAV_CHANNELS * self.WAV_SAMPLE_SIZE
+        frame, skip = divmod(max(offset - self.WAV_HEADER_SIZE, 0), frame_size)
+        return float(frame) / self.WAV_SAMPLE_RATE, skip
+
+    def wav_size(self, length):
+        """Returns the estimated size in bytes of a wav stream of length seconds"""
+        return (self.WAV_HEADER_SIZE +
+                length * self.WAV_SAMPLE_RATE * self.WAV_CHANNELS * self.WAV_SAMPLE_SIZE)
+
+    def segment_count(self, length):
+        """Returns the number of segments for an item of length seconds"""
+        return max(int(math.ceil(float(length) / self.SEGMENT_DURATION)), 1)
+
+    def get_playlist(self, length, segment_url):
+        """Returns the HLS playlist for an item of length seconds.
+        segment_url is formatted with the index of each segment.
+        """
+        lines = [
+            '#EXTM3U', '#EXT-X-VERSION:3',
+            '#EXT-X-TARGETDURATION:%i' % self.SEGMENT_DURATION,
+            '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-PLAYLIST-TYPE:VOD'
+        ]
+        count = self.segment_count(length)
+        for index in range(count):
+            duration = self.SEGMENT_DURATION
+            if index == count - 1 and length > index * self.SEGMENT_DURATION:
+                duration = length - index * self.SEGMENT_DURATION
+            lines.append('#EXTINF:%.3f,' % duration)
+            lines.append(segment_url % index)
+        lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+    def get_cached_segment(self, media_id, index):
+        """Gets the file name of the cached segment or returns None"""
+        return self.cache.get(media_id, self._segment_format(index))
+
+    def start_segment_transcode(self, path, media_id, index, priority=TranscodeScheduler.INTERACTIVE):
+        """Transcode a single segment of the item. Returns the
+        TranscodeJob, shared with any transcode of the segment in progress.
+        """
+        file_format = self._segment_format(index)
+        job = self.active_jobs.get_or_start(
+            media_id, file_format,
+            lambda: self._start_job(
+                self._get_segment_command(path, index), media_id, file_format, priority, True
+            )
+        )
+        self.scheduler.prioritise(job, priority)
+        return job
+
+    def prefetch_segments(self, path, media_id, index, length):
+        """Queues transcodes for up to SEGMENT_LOOKAHEAD segments from
+        index which are not already cached. Nearer segments are given a
+        higher priority, all below interactive requests and above
+        background transcodes, so they run in parallel on any free slots.
+        """
+        cached_formats = set(self.cache.formats(media_id))
+        end = min(index + self.SEGMENT_LOOKAHEAD, self.segment_count(length))
+        for distance, segment in enumerate(range(index, end), 1):
+            if self._segment_format(segment) not in cached_formats:
+                priority = min(TranscodeScheduler.INTERACTIVE + distance,
+                               TranscodeScheduler.BACKGROUND - 1)
+                self.start_segment_transcode(path, media_id, segment, priority)
+
+    def prefetch_items(self, items, accept, profile=None):
+        """Queues background transcodes for the items which cannot be
+        sent in their original or a cached format, in order, so they are
+        ready when played. The items are transcoded with the first profile
+        accepted by the client, and nothing is queued if it accepts none.
+        If a profile is given, the items not cached in that profile are
+        transcoded. Items already being transcoded are skipped.
+        Stops once the prefetched files which have not been played, with
+        the queued transcodes estimated from the source file sizes, would
+        fill more than PREFETCH_CACHE_SHARE of the cache.
+        Returns the number of transcodes queued.
+        """
+        negotiated = profile is None
+        if negotiated:
+            profile = self.get_accepted_profile(accept)
+            if profile is None:
+                return 0
+        budget = self.prefetch_budget()
+        queued = 0
+        for item in items:
+            if negotiated:
+                # Also finds the item cached in the accepted profile
+                self.get_output_type(item, accept, background=True)
+                cached = item.cached
+            else:
+                cached = profile.file_format in self.cache.formats(item.id)
+            if cached or self.is_transcoding(item.id):
+                continue
+            budget -= item.size
+            if budget < 0:
+                self.logger.info("Prefetch stopped at %s, cache budget reached" % item.id)
+                break
+            self.start_transcode(item.path, item.id, background=True, profile=profile)
+            queued += 1
+        return queued
+
+    def prefetch_budget(self):
+        """Returns the number of bytes which may still be prefetched into
+        the cache. Played files are left to the cache eviction, so only
+        prefetched files which have not been played count against it.
+        """
+        return self.cache.MAX_SIZE * self.PREFETCH_CACHE_SHARE - self.cache.prefetched_size()
+
+    def _segment_format(self, index):
+        """Returns the cache format of a segment"""
+        return '%i.%s' % (index, self.SEGMENT_EXT)
+
+    def is_transcoding(self, media_id):
+        """Returns True if a transcode is in progress for the item in any format"""
+        return len(self.active_jobs.find(media_id)) > 0
 
     def _get_cache_file_name(self, media_id, container):
         """Returns the full path of the cache file."""
@@ -148,75 +499,168 @@ class Transcoder(ComponentBase):
             config.CACHE_DIR, "%s.%s" % (media_id, container)
         )
 
-    def _on_ffmpeg_complete(self, ffmpeg_proc, tmp_name, media_id, cache_file_name, terminated=False):
+    def _on_ffmpeg_complete(self, job):
         """Checks the return status of ffmpeg and updates the transcode cache"""
-        if ffmpeg_proc.returncode != 0:
-            os.unlink(cache_file_name)  # Remove incomplete files
-        else:
+        if job.succeeded:
             self.logger.info('Transcode complete, saving to cache')
-            self.add_cached_file(media_id, cache_file_name)
-        if ffmpeg_proc.returncode != 0 and not terminated:
-            with open(tmp_name, 'r') as tmp_in:
-                self.logger.error(
-                    "ffmpeg returned %i\n%s" % (ffmpeg_proc.returncode, tmp_in.read())
-                )
+            # Background jobs which were not raised for playback are prefetches
+            self.add_cached_file(
+                job.media_id, job.out_file, job.container, verified=True,
+                prefetched=job.priority >= TranscodeScheduler.BACKGROUND
+            )
+        elif job.returncode and not job.cancelled:
+            self.logger.error(
+                "ffmpeg returned %i\n%s" % (job.returncode, job.read_errors())
+            )
+        self.active_jobs.remove(job)
 
-    def add_cached_file(self, media_id, path, file_format=None):
+    def add_cached_file(self, media_id, path, file_format=None, verified=False, prefetched=False):
         """Add an item to the transcode cache"""
-        if file_format is None:
-            file_format = os.path.splitext(path)[1][1:]
-        item_cache = self.transcode_cache.setdefault(media_id, {})
-        item_cache[file_format] = path
+        self.cache.add(media_id, path, file_format, verified, prefetched)
 
-    def get_cached_file(self, media_id, file_format):
+    def get_cached_file(self, media_id, file_format, length=None):
         """Gets the file name of the cached transcode file or
-        returns None if no file exists.
+        returns None if no file exists. Files not known to be complete
+        are checked with ffprobe, against the item length if given.
         """
-        if media_id in self.transcode_cache:
-            return self.transcode_cache[media_id].get(file_format)
-        return None
+        return self.cache.get(
+            media_id, file_format, lambda path: self._verify_cached_file(path, length)
+        )
 
-    def _start_ffmpeg(self, path, tmp, out_file, codec, container):
-        """Starts ffmpeg"""
-        self.logger.info("Starting transcode for %s" % path)
-        if out_file != '-':
-            stdout = open(os.devnull, 'w')
+    def _verify_cached_file(self, path, length):
+        """Returns True if ffprobe can read the file and its duration
+        is within a second of the expected length
+        """
+        info = self.probe_media_info(path)
+        if info is None or info['duration'] is None:
+            return False
+        return length is None or abs(info['duration'] - length) <= 1
+
+    def _start_ffmpeg(self, path, media_id, codec, container, file_format, priority, cached,
+                      bitrate=None, profile=None):
+        """Queues a new TranscodeJob to run ffmpeg"""
+        self.logger.info("Queueing transcode for %s" % path)
+        return self._start_job(
+            self._get_ffmpeg_command(path, codec, container, bitrate=bitrate, profile=profile),
+            media_id, file_format, priority, cached, self.__REMUX_OPTIONS.get(container)
+        )
+
+    def _start_job(self, cmd, media_id, file_format, priority, cached, remux=None):
+        """Queues a TranscodeJob, whose output is saved to the cache if
+        cached is set, remuxed with the remux output options if given
+        """
+        out_file = None
+        if cached:
+            out_file = self._get_cache_file_name(media_id, file_format)
         else:
-            stdout = subprocess.PIPE
-        if os.path.exists(out_file):
-            os.unlink(out_file)
-        cmd = ['ffmpeg', '-i', path, '-acodec', codec]
-        if container is not 'wav':
-            cmd.extend(['-aq', self.AUDIO_QUALITY])
-        cmd.extend(['-map', 'a', '-f', container, out_file])
-        return subprocess.Popen(cmd, bufsize=self.BUF_SIZE, stdout=stdout, stderr=tmp)
+            remux = None
+        job = TranscodeJob(
+            cmd, out_file, self.cache.get_partial_file_name(media_id, file_format),
+            media_id, file_format, self._on_ffmpeg_complete, remux
+        )
+        return self.scheduler.submit(job, priority)
+
+    def _get_ffmpeg_command(self, path, codec, container, start=None, bitrate=None,
+                            profile=None):
+        """Returns the ffmpeg command line to transcode the file to stdout,
+        optionally starting at start seconds, and at bitrate kbps for
+        live transcodes. The profile's options are used if given.
+        """
+        cmd = ['ffmpeg']
+        if start:
+            cmd.extend(['-ss', '%.6f' % start])
+        cmd.extend(['-i', path])
+        if profile is not None:
+            cmd.extend(profile.get_options())
+        elif codec == 'pcm_s16le':
+            # Write a plain 44 byte header and a fixed sample format
+            cmd.extend([
+                '-acodec', codec, '-ar', str(self.WAV_SAMPLE_RATE), '-ac', str(self.WAV_CHANNELS),
+                '-map_metadata', '-1', '-fflags', '+bitexact'
+            ])
+        elif bitrate is not None:
+            cmd.extend(['-acodec', codec, '-b:a', '%ik' % bitrate])
+            if codec == 'libopus':
+                cmd.extend(['-frame_duration', self.LIVE_FRAME_DURATION])
+            cmd.extend(self.__LIVE_MUXER_OPTIONS.get(container, []))
+        else:
+            cmd.extend(['-acodec', codec, '-aq', self.AUDIO_QUALITY])
+        cmd.extend(['-map', 'a'] + self.__MUXER_OPTIONS.get(container, ['-f', container]) + ['-'])
+        return cmd
+
+    def _get_segment_command(self, path, index):
+        """Returns the ffmpeg command line to transcode a segment to
+        MPEG-TS on stdout. Timestamps are offset to the segment start so
+        consecutive segments play back continuously.
+        """
+        start = '%.6f' % (index * self.SEGMENT_DURATION)
+        return [
+            'ffmpeg', '-ss', start, '-i', path, '-t', str(self.SEGMENT_DURATION),
+            '-acodec', self.SEGMENT_CODEC, '-b:a', self.SEGMENT_BITRATE,
+            '-map', 'a', '-output_ts_offset', start, '-f', 'mpegts', '-'
+        ]
 
     def get_media_info(self, path):
-        """Gets the media metadata using ffmpeg"""
-        cmd = ['ffprobe', '-i', path]
+        """Gets the media metadata. Returns a dict of the 'duration' in
+        seconds, the 'codec', 'bitrate', 'sample_rate' and 'channels' of
+        the first audio stream, and a dict of 'tags' with lower case names.
+        Values which are not known are None. The file headers are read
+        directly for common formats, falling back to ffprobe.
+        Returns None if the file cannot be read.
+        """
+        if self.NATIVE_TAGS:
+            info = read_media_info(path)
+            if info is not None:
+                return info
+        return self.probe_media_info(path)
+
+    def probe_media_info(self, path):
+        """Gets the media metadata using ffprobe, see get_media_info.
+        Returns None if ffprobe fails.
+        """
+        cmd = ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format',
+               '-show_streams', path]
         proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        _, stderr = proc.communicate()
+        stdout, stderr = proc.communicate()
         if proc.returncode != 0:
             self.logger.error("ffprobe returned %i\n%s" % (proc.returncode, stderr))
             return None
-        return self._parse_metadata(stderr)  # FFProbe outputs stderr normally
-
-    def _parse_metadata(self, data):
-        """Parse the output of ffprobe and return a dict of
-        file metadata.
-        """
-        info = {}
-        active_re = self.metadata_start_re
-        for line in data.splitlines():
-            match = active_re.match(line)
-            if match:
-                if active_re is self.metadata_start_re:
-                    active_re = self.metadata_re
-                    continue
-                info[match.group(1).lower()] = match.group(2)
-            else:
-                if active_re is self.metadata_re:
-                    active_re = self.duration_re
-                elif active_re is self.duration_re:
-                    break
-        return info
+        try:
+            return self._parse_metadata(json.loads(stdout))
+        except ValueError as e:
+            self.logger.error("Invalid ffprobe output for %s: %s" % (path, str(e)))
+            return None
+
+    def _parse_metadata(self, probe):
+        """Parse the JSON output of ffprobe and return a dict of
+        file metadata, see get_media_info.
+        """
+        file_format = probe.get('format', {})
+        stream = {}
+        for entry in probe.get('streams', []):
+            if entry.get('codec_type') == 'audio':
+                stream = entry
+                break
+        # Tags may be held on the stream (ogg, flac) or the container
+        tags = {}
+        for source in (stream, file_format):
+            for name, value in source.get('tags', {}).items():
+                tags[name.lower()] = value
+        return {
+            'duration': self._to_number(
+                file_format.get('duration') or stream.get('duration'), float
+            ),
+            'codec': stream.get('codec_name'),
+            'bitrate': self._to_number(stream.get('bit_rate') or file_format.get('bit_rate'), int),
+            'sample_rate': self._to_number(stream.get('sample_rate'), int),
+            'channels': self._to_number(stream.get('channels'), int),
+            'tags': tags
+        }
+
+    @staticmethod
+    def _to_number(value, number_type):
+        """Converts an ffprobe value, returning None if it is missing or invalid"""
+        try:
+            return number_type(value)
+        except (TypeError, ValueError):
+            return None
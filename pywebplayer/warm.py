@@ -0,0 +1,191 @@
+#!/usr/bin/python
+"""Script for filling the transcode cache ahead of playback, so it can be
+run off-peak. Items already in the cache are skipped, so an interrupted
+run is resumed by running the script again.
+This script should be run as www-data.
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+from multiprocessing import cpu_count
+from subprocess import check_call, CalledProcessError
+
+from config import config
+from model import MediaLibrary
+from transcode import Transcoder
+
+# ionice scheduling classes
+_IONICE_CLASSES = {'realtime': '1', 'best-effort': '2', 'idle': '3'}
+
+
+def select_items(library, transcoder, profile, formats=None, recent=None, most_played=None):
+    """Returns the items to transcode. The items are those of the given
+    source formats, modified within recent days, or the most_played items
+    with the most cache hits, or all items if none are given. Items which
+    are already cached in the profile, or already in the profile's type,
+    are excluded.
+    """
+    if most_played is not None:
+        items = [library.get_item(media_id) for media_id in transcoder.cache.most_hit(most_played)]
+        items = [item for item in items if item is not None]
+    elif recent is not None:
+        items = list(library.iter_query(
+            "mtime >= ?", (time.time() - recent * 24 * 3600,), order_by='mtime DESC'
+        ))
+    else:
+        items = list(library.iter_query(order_by='id'))
+    if formats is not None:
+        items = [item for item in items if _source_format(item) in formats]
+    return [
+        item for item in items
+        if item.mime_type != profile.mime_type and
+        profile.file_format not in transcoder.cache.formats(item.id)
+    ]
+
+
+def _source_format(item):
+    return os.path.splitext(item.path)[1][1:].lower()
+
+
+def warm_cache(transcoder, items, profile, progress=None):
+    """Transcodes the items into the cache with the profile, running up
+    to the scheduler's MAX_CONCURRENT transcodes at once. Stops before the
+    transcodes not yet played would fill more than PREFETCH_CACHE_SHARE of
+    the cache, the same budget as prefetching. Calls progress with the
+    stats after each item. Returns the stats.
+    """
+    stats = {'done': 0, 'failed': 0, 'remaining': len(items), 'seconds': 0.0, 'start': time.time()}
+    budget = transcoder.prefetch_budget()
+    jobs = []  # Queued jobs, oldest first, with the item duration
+    try:
+        for item in items:
+            budget -= item.size
+            if budget < 0:
+                transcoder.logger.warning("Cache budget reached, stopping at %s" % item.id)
+                break
+            job = transcoder.start_transcode(item.path, item.id, background=True, profile=profile)
+            jobs.append((job, item.duration or item.length))
+            # Keep a window of queued jobs rather than queueing the whole library
+            if len(jobs) >= transcoder.scheduler.MAX_CONCURRENT * 2:
+                _wait_for_job(jobs, stats, progress)
+        while jobs:
+            _wait_for_job(jobs, stats, progress)
+    except KeyboardInterrupt:
+        # Stop ffmpeg, the partial files are removed as the jobs complete
+        for job, _ in jobs:
+            job.cancel()
+        for job, _ in jobs:
+            job.wait()
+        raise
+    return stats
+
+
+def _wait_for_job(jobs, stats, progress):
+    """Waits for the oldest job to complete, then removes it from jobs"""
+    job, duration = jobs[0]
+    while not job.done:
+        job.wait(1)  # Wake periodically so KeyboardInterrupt is handled
+    jobs.pop(0)
+    if job.succeeded:
+        stats['done'] += 1
+        stats['seconds'] += duration
+    else:
+        stats['failed'] += 1
+    stats['remaining'] -= 1
+    if progress is not None:
+        progress(stats)
+
+
+def _rates(stats):
+    """Returns the files transcoded per minute and the realtime factor,
+    the seconds of audio transcoded per second
+    """
+    elapsed = max(time.time() - stats['start'], 1e-3)
+    return stats['done'] * 60 / elapsed, stats['seconds'] / elapsed
+
+
+def _print_progress(stats):
+    """Prints the progress on a single line"""
+    files_per_min, factor = _rates(stats)
+    sys.stdout.write(
+        "\rTranscoded %i items, %i failed, %i remaining (%.1f files/min, %.1fx realtime)" %
+        (stats['done'], stats['failed'], stats['remaining'], files_per_min, factor)
+    )
+    sys.stdout.flush()
+
+
+def set_priority(niceness, ionice_class):
+    """Lowers the CPU and IO priority of this process, which is inherited
+    by the ffmpeg processes
+    """
+    if niceness:
+        os.nice(niceness)
+    if ionice_class != 'none':
+        try:
+            check_call(['ionice', '-c', _IONICE_CLASSES[ionice_class], '-p', str(os.getpid())])
+        except (OSError, CalledProcessError) as e:
+            print >> sys.stderr, "Failed to set the IO priority: %s" % str(e)
+
+
+def _parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Transcodes library items into the cache ahead of playback"
+    )
+    select = parser.add_mutually_exclusive_group()
+    select.add_argument('--recent', type=float, metavar='DAYS',
+                        help="only items added or modified within DAYS days")
+    select.add_argument('--most-played', type=int, metavar='N',
+                        help="only the N items with the most cache hits")
+    parser.add_argument('--format', metavar='EXT[,EXT...]',
+                        help="only items with these source file extensions, eg. flac,wav")
+    parser.add_argument('--profile', default='default',
+                        help="output profile configured in app.ini (default: %(default)s)")
+    parser.add_argument('-j', '--jobs', type=int, default=cpu_count(),
+                        help="number of concurrent transcodes (default: %(default)s)")
+    parser.add_argument('--nice', type=int, default=19,
+                        help="niceness increment (default: %(default)s)")
+    parser.add_argument('--ionice', choices=sorted(_IONICE_CLASSES) + ['none'], default='idle',
+                        help="IO scheduling class (default: %(default)s)")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    """Entry point for the script"""
+    args = _parse_args(args)
+    logging.basicConfig(level=logging.WARNING, format=config.LOG_FORMAT)
+    set_priority(args.nice, args.ionice)
+    formats = None
+    if args.format is not None:
+        formats = set(ext.strip().lower().lstrip('.') for ext in args.format.split(','))
+    transcoder = Transcoder()
+    transcoder.scheduler.MAX_CONCURRENT = max(args.jobs, 1)
+    try:
+        profile = transcoder.get_profile(name=args.profile)
+    except KeyError:
+        print >> sys.stderr, "Unknown profile %s" % args.profile
+        return 2
+    with MediaLibrary(read_only=True) as library:
+        items = select_items(
+            library, transcoder, profile, formats, args.recent, args.most_played
+        )
+    if len(items) == 0:
+        print "Nothing to transcode"
+        return 0
+    print "Transcoding %i items with %i jobs..." % (len(items), transcoder.scheduler.MAX_CONCURRENT)
+    try:
+        stats = warm_cache(transcoder, items, profile, _print_progress)
+    except KeyboardInterrupt:
+        print "\nInterrupted, run again to resume"
+        return 1
+    files_per_min, factor = _rates(stats)
+    print "\nTranscoded %i items (%.0f seconds of audio) in %.0f seconds, %i failed" % (
+        stats['done'], stats['seconds'], time.time() - stats['start'], stats['failed']
+    )
+    print "%.1f files/min, %.1fx realtime" % (files_per_min, factor)
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
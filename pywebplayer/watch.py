@@ -0,0 +1,211 @@
+import os
+import sys
+import time
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+from config import ComponentBase
+
+__all__ = ["InotifyWatcher", "PollingWatcher", "create_watcher"]
+
+
+def create_watcher(paths, max_depth):
+    """Returns an InotifyWatcher for the paths, or a PollingWatcher
+    if inotify is not available
+    """
+    try:
+        return InotifyWatcher(paths, max_depth)
+    except (OSError, AttributeError) as e:
+        watcher = PollingWatcher(paths, max_depth)
+        watcher.logger.warning("inotify is not available, polling for changes: %s" % str(e))
+        return watcher
+
+
+class InotifyWatcher(ComponentBase):
+    """Watches directory trees, up to max_depth levels deep, for created,
+    written, moved and deleted files using the Linux inotify API.
+    """
+
+    # Event flags, from sys/inotify.h
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                  IN_DELETE_SELF | IN_MOVE_SELF)
+
+    EVENT_HEADER = struct.Struct('iIII')
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, paths, max_depth):
+        super(InotifyWatcher, self).__init__()
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._inotify_add_watch = libc.inotify_add_watch
+        self._inotify_rm_watch = libc.inotify_rm_watch
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        # Paths are passed to inotify as bytes
+        self.paths = [
+            path.encode(sys.getfilesystemencoding()) if isinstance(path, unicode) else path
+            for path in paths
+        ]
+        self.max_depth = max_depth
+        self._watches = {}  # Watch descriptor to (path, depth)
+        for path in self.paths:
+            self._watch_tree(path, 0)
+
+    def _watch_tree(self, path, depth):
+        """Adds watches for the directory and its sub directories"""
+        if depth >= self.max_depth:
+            return
+        wd = self._inotify_add_watch(self.fd, path, self.WATCH_MASK)
+        if wd < 0:
+            self.logger.warning(
+                "Cannot watch %s: %s" % (path, os.strerror(ctypes.get_errno()))
+            )
+            return
+        self._watches[wd] = (path, depth)
+        try:
+            entries = os.listdir(path)
+        except OSError as e:
+            self.logger.warning(str(e))
+            return
+        for entry in entries:
+            sub_path = os.path.join(path, entry)
+            if os.path.isdir(sub_path) and not os.path.islink(sub_path):
+                self._watch_tree(sub_path, depth + 1)
+
+    def read(self, timeout=None):
+        """Waits up to timeout seconds, or indefinitely if None, for
+        events. Returns the list of files and directories which have
+        changed, decoded with the filesystem encoding. If events were
+        lost, the watched paths are returned.
+        """
+        try:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        if len(ready) == 0:
+            return []
+        buf = os.read(self.fd, self.READ_SIZE)
+        changed = []
+        pos = 0
+        while pos + self.EVENT_HEADER.size <= len(buf):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(buf, pos)
+            pos += self.EVENT_HEADER.size
+            name = buf[pos:pos + length].rstrip('\x00')
+            pos += length
+            if mask & self.IN_Q_OVERFLOW:
+                self.logger.warning("inotify queue overflowed, rescanning")
+                changed.extend(self.paths)
+                continue
+            if wd not in self._watches:
+                continue
+            if mask & self.IN_IGNORED:
+                del self._watches[wd]
+                continue
+            parent, depth = self._watches[wd]
+            if mask & self.IN_MOVE_SELF and not os.path.isdir(parent):
+                # Moved out of the tree, moves within the tree re-add the watch
+                self._inotify_rm_watch(self.fd, wd)
+                continue
+            if not name:
+                continue
+            path = os.path.join(parent, name)
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                self._watch_tree(path, depth + 1)
+            changed.append(path)
+        return [path for path in (self._decode(path) for path in changed) if path is not None]
+
+    def _decode(self, path):
+        """Returns the path as unicode, as the library stores paths, or
+        None if it cannot be decoded
+        """
+        try:
+            return path.decode(sys.getfilesystemencoding())
+        except UnicodeDecodeError:
+            self.logger.warning("Ignoring change to undecodable path %r" % path)
+            return None
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(ComponentBase):
+    """Watches directory trees, up to max_depth levels deep, by comparing
+    the size and modification time of every file every POLL_INTERVAL
+    seconds
+    """
+
+    POLL_INTERVAL = 60
+
+    def __init__(self, paths, max_depth):
+        super(PollingWatcher, self).__init__()
+        self._load_config()
+        self.paths = paths
+        self.max_depth = max_depth
+        self._snapshot = self._scan()
+        self._next_poll = time.time() + self.POLL_INTERVAL
+
+    def _scan(self):
+        """Returns a dict mapping each file and directory in the
+        trees to its signature
+        """
+        snapshot = {}
+        paths = list(self.paths)
+        depth = 0
+        while len(paths) > 0 and depth < self.max_depth:
+            sub_paths = []
+            for path in paths:
+                try:
+                    entries = os.listdir(path)
+                except OSError:
+                    continue
+                for entry in entries:
+                    if isinstance(path, unicode) and not isinstance(entry, unicode):
+                        continue  # Not decodable with the filesystem encoding
+                    sub_path = os.path.join(path, entry)
+                    try:
+                        stat = os.stat(sub_path)
+                    except OSError:
+                        continue
+                    snapshot[sub_path] = (stat.st_size, stat.st_mtime, stat.st_ino)
+                    if os.path.isdir(sub_path):
+                        sub_paths.append(sub_path)
+            paths = sub_paths
+            depth += 1
+        return snapshot
+
+    def read(self, timeout=None):
+        """Waits up to timeout seconds, or until the next poll, for
+        changes. Returns the list of files and directories which have
+        changed.
+        """
+        delay = self._next_poll - time.time()
+        if timeout is not None and timeout < delay:
+            time.sleep(max(timeout, 0))
+            return []
+        time.sleep(max(delay, 0))
+        self._next_poll = time.time() + self.POLL_INTERVAL
+        snapshot = self._scan()
+        changed = [
+            path for path, signature in snapshot.iteritems()
+            if self._snapshot.get(path) != signature
+        ]
+        changed.extend(path for path in self._snapshot if path not in snapshot)
+        self._snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
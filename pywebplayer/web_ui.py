@@ -1,5 +1,10 @@
 import os
+import json
+import errno
+import email.utils
+import mimetypes
 import bottle
+from urllib import urlencode
 import logging
 from bottle import response, request, view, HTTPError
 
@@ -16,6 +21,16 @@ _transcoder = Transcoder()
 
 _logger = logging.getLogger(__name__)
 
+# Fraction of the client's reported downlink used for live streams
+_DOWNLINK_SHARE = 0.5
+
+
+def _library():
+    """Returns a read only library using the request thread's
+    persistent connection
+    """
+    return MediaLibrary(read_only=True, pooled=True)
+
 
 def _format_time(secs):
     """Format the time according to [hrs:]mins:secs
@@ -31,96 +46,522 @@ def _format_time(secs):
 @app.route('/')
 @view('listing')
 def list_all():
-    """List all items in the library"""
-    data = {'items': [], 'listing_title': 'All Media'}
-    with MediaLibrary() as library:
-        items = library.get_all()
-        for item in items:
-            data['items'].append((item.id, item.name, _format_time(item.length)))
+    """List a page of the items in the library"""
+    items, next_cursor = _get_page()
+    data = {
+        'items': [], 'listing_title': 'All Media', 'next_url': None,
+        'player_query': _order_query()
+    }
+    for item in items:
+        data['items'].append(_item_row(item))
+    if next_cursor is not None:
+        data['next_url'] = '/?' + _page_query(next_cursor)
+    return data
+
+
+@app.route('/api/media')
+def list_all_json():
+    """List a page of the items in the library as JSON"""
+    items, next_cursor = _get_page(with_props=True)
+    data = {'items': [], 'next': None}
+    for item in items:
+        data['items'].append(_item_dict(item))
+    if next_cursor is not None:
+        data['next'] = '/api/media?' + _page_query(next_cursor)
     return data
 
 
+@app.route('/api/media/export')
+def export_json():
+    """Stream every item in the library as a JSON array"""
+    response.set_header('Content-Type', 'application/json')
+    return _export_generator()
+
+
+def _export_generator():
+    """Generator for the JSON export, yielding one chunk per batch of items"""
+    with _library() as library:
+        separator = '['
+        batch = []
+        for item in library.iter_all(with_props=True):
+            batch.append(json.dumps(_item_dict(item)))
+            if len(batch) == library.FETCH_SIZE:
+                yield separator + ','.join(batch)
+                separator = ','
+                batch = []
+        if len(batch) > 0:
+            yield separator + ','.join(batch)
+            separator = ','
+        yield ']' if separator == ',' else '[]'
+
+
+@app.route('/search')
+@view('listing')
+def search():
+    """List the items matching the search query"""
+    data = {
+        'items': [], 'listing_title': 'Search: %s' % request.query.q, 'next_url': None,
+        'player_query': ''
+    }
+    for item in _search():
+        data['items'].append(_item_row(item))
+    return data
+
+
+@app.route('/api/search')
+def search_json():
+    """List the items matching the search query as JSON"""
+    data = {'items': []}
+    for item in _search(with_props=True):
+        data['items'].append(_item_dict(item))
+    return data
+
+
+def _search(with_props=False):
+    """Gets the items matching the q and limit query parameters"""
+    try:
+        limit = int(request.query.limit) if request.query.limit else None
+    except ValueError as e:
+        raise HTTPError(400, str(e))
+    with _library() as library:
+        return library.search(request.query.getunicode('q', default=''), limit, with_props)
+
+
+def _get_page(with_props=False):
+    """Gets the page of items selected by the sort, order, after
+    and limit query parameters
+    """
+    query = request.query
+    try:
+        limit = int(query.limit) if query.limit else None
+        with _library() as library:
+            return library.get_page(
+                query.sort or 'name', query.after or None, limit, query.order == 'desc',
+                with_props
+            )
+    except ValueError as e:
+        raise HTTPError(400, str(e))
+
+
+def _item_row(item):
+    """Returns the listing template row for an item"""
+    return (item.id, item.name, item.artist, item.album, _format_time(item.length))
+
+
+def _item_dict(item):
+    """Returns the JSON representation of an item"""
+    return {
+        'id': item.id, 'name': item.name, 'artist': item.artist, 'album': item.album,
+        'length': item.length, 'duration': item.duration, 'mime_type': item.mime_type,
+        'codec': item.codec, 'bitrate': item.bitrate, 'sample_rate': item.sample_rate,
+        'channels': item.channels, 'props': item.props
+    }
+
+
+def _order_query():
+    """Returns the query string, including the leading '?', passing the
+    listing order on to the player, or an empty string for the default
+    """
+    params = dict(
+        (key, request.query.get(key)) for key in ('sort', 'order') if request.query.get(key)
+    )
+    return '?' + urlencode(params) if params else ''
+
+
+def _page_query(cursor):
+    """Returns the query string for the page following the cursor"""
+    params = {'after': cursor}
+    for key in ('sort', 'order', 'limit'):
+        if request.query.get(key):
+            params[key] = request.query.get(key)
+    return urlencode(params)
+
+
 @app.route('/stream/<media_id>')
 def play_item(media_id):
     """Sends the file directly if possible or
     transcodes the file into a format the browser
-    supports
+    supports. The start query parameter streams
+    an item which must be transcoded from the given
+    time in seconds.
     """
     item = _get_item(media_id)
-    receive_type = _transcoder.get_output_type(
-        item, request.get_header('accept', default='').split(',')
-    )
-    if not item.cached:
-        # Wait for item to finish transcoding
-        proc = _transcoder.start_transcode(item.path, item.id)
-        proc.wait()
-    _transcoder.check_background_processes()
-    _set_stream_header(item, receive_type)
-    if not item.cached:
-        # TODO - Not currently reached
-        default_range = 'bytes=0-'
+    try:
+        start = float(request.query.start or 0)
+    except ValueError as e:
+        raise HTTPError(400, str(e))
+    if not 0 < start < item.length:
+        start = 0
+    profile = _request_profile()
+    if not start and request.get_header('range', default='bytes=0-') in ('', 'bytes=0-'):
+        _prefetch_following(item, profile)
+    if profile is not None:
+        return _stream_profile(item, profile, start)
+    bitrate = _transcoder.get_live_bitrate(_max_bitrate())
+    while True:
+        item.cached = False
+        receive_type = _transcoder.get_output_type(
+            item, request.get_header('accept', default=''), bitrate=bitrate
+        )
+        file_path = _set_stream_header(
+            item, receive_type, not _transcoder.is_reduced_bitrate(bitrate)
+        )
+        if file_path is not None or not item.cached:
+            break
+        # The cached file failed its check and was removed, so negotiate again
+    if file_path is not None and not _use_x_sendfile():
+        return _serve_file(file_path)
+    if file_path is None and start:
+        # Cached and original files are seeked with range requests
+        return _seek_item(item, start)
+    if file_path is None:
         request_range = request.get_header('range', default='bytes=0-')
-        if request_range != '' and not request_range.startswith(default_range):
-            raise HTTPError(
-                code=416, output="Cannot handle range request, transcode still in progress"
-            )
-        return _transcoder.start_transcode(item.path, item.id)
+        offset = 0
+        if request_range not in ('', 'bytes=0-'):
+            ranges = list(bottle.parse_range_header(request_range, _transcoder.wav_size(item.length)))
+            if len(ranges) != 1 or receive_type != _transcoder.MIME_MAP['wav']:
+                raise HTTPError(
+                    416, "Cannot handle range request, transcode still in progress"
+                )
+            offset = ranges[0][0]
+        if offset > 0:
+            return _stream_range(item, offset)
+        # Stream the output while it is being written to the cache
+        job = _transcoder.start_transcode(
+            item.path, item.id, container=receive_type.split('/')[1], bitrate=bitrate
+        )
+        return job.stream(_transcoder.BUF_SIZE)
     else:
         return
 
 
+def _stream_profile(item, profile, start=0):
+    """Sends the item transcoded with the profile, from the cache or
+    while it is being transcoded into the cache. If the item is not
+    cached and start is set, it is streamed from start seconds.
+    """
+    file_path = _set_stream_header(item, profile.mime_type, file_format=profile.file_format)
+    if file_path is not None:
+        if not _use_x_sendfile():
+            return _serve_file(file_path)
+        return
+    if start:
+        return _seek_item(item, start)
+    job = _transcoder.start_transcode(item.path, item.id, profile=profile)
+    return job.stream(_transcoder.BUF_SIZE)
+
+
+def _request_profile():
+    """Gets the output profile named by the profile query parameter, or
+    the Save-Data profile for clients which send Save-Data. Returns None
+    if no profile is selected, in which case the output type is negotiated.
+    """
+    name = request.query.profile
+    if not name and _save_data():
+        name = _transcoder.SAVE_DATA_PROFILE
+    if not name:
+        return None
+    try:
+        return _transcoder.get_profile(name=name)
+    except KeyError:
+        raise HTTPError(400, "Unknown profile %s" % name)
+
+
+def _save_data():
+    """Returns True if the client asks to reduce data usage"""
+    return request.get_header('save-data', default='').strip().lower() == 'on'
+
+
+def _prefetch_following(item, profile=None):
+    """Queues background transcodes of the items following the item in
+    the listing order given by the sort and order query parameters, which
+    is album order by default
+    """
+    if _transcoder.PREFETCH_DEPTH <= 0:
+        return
+    try:
+        with _library() as library:
+            items = library.get_following(
+                item, request.query.sort or 'album', _transcoder.PREFETCH_DEPTH,
+                request.query.order == 'desc'
+            )
+    except ValueError as e:
+        raise HTTPError(400, str(e))
+    _transcoder.prefetch_items(items, request.get_header('accept', default=''), profile)
+
+
+def _max_bitrate():
+    """Gets the maximum live bitrate in kbps from the bitrate query
+    parameter, or from the Save-Data and Downlink client hints.
+    Returns None if there is no limit.
+    """
+    if request.query.bitrate:
+        try:
+            return int(request.query.bitrate)
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+    if _save_data():
+        return 0
+    try:
+        # Downlink is the client's estimated bandwidth in Mbps
+        return float(request.get_header('downlink')) * 1000 * _DOWNLINK_SHARE
+    except (TypeError, ValueError):
+        return None
+
+
+def _seek_item(item, start):
+    """Streams the item from start seconds, transcoding from that
+    point in the source file
+    """
+    job = _transcoder.start_seek_transcode(item.path, item.id, start)
+    response.set_header('Pragma', 'no-cache')
+    response.set_header('Content-Type', _transcoder.MIME_MAP['wav'])
+    response.set_header('X-Content-Duration', str(item.length - start))
+    return job.stream(_transcoder.BUF_SIZE, cancel_on_close=True)
+
+
+def _stream_range(item, offset):
+    """Streams the wav output of an item from the given byte offset.
+    Offsets already written by a transcode in progress are read from its
+    output, other offsets are mapped to a time and transcoded from that
+    point.
+    """
+    total = _transcoder.wav_size(item.length)
+    response.status = 206
+    response.set_header('Content-Range', 'bytes %i-%i/%i' % (offset, total - 1, total))
+    job = _transcoder.active_jobs.get(item.id, 'wav')
+    if job is not None and offset <= job.bytes_written:
+        return job.stream(_transcoder.BUF_SIZE, offset)
+    start, skip = _transcoder.wav_offset_to_time(offset)
+    job = _transcoder.start_seek_transcode(item.path, item.id, start, raw=True)
+    return job.stream(_transcoder.BUF_SIZE, skip, cancel_on_close=True)
+
+
+@app.route('/hls/<media_id>.m3u8')
+def hls_playlist(media_id):
+    """Sends the HLS playlist for the item, listing its segments"""
+    item = _get_item(media_id)
+    response.set_header('Content-Type', _transcoder.PLAYLIST_TYPE)
+    return _transcoder.get_playlist(
+        item.duration or item.length, '/hls/%s/%%i.%s' % (item.id, _transcoder.SEGMENT_EXT)
+    )
+
+
+@app.route('/hls/<media_id>/<index:int>.ts')
+def hls_segment(media_id, index):
+    """Sends a segment of the item from the cache, or transcodes it.
+    The following segments are transcoded ahead of playback.
+    """
+    item = _get_item(media_id)
+    length = item.duration or item.length
+    if index >= _transcoder.segment_count(length):
+        raise HTTPError(404, "Segment %i of item %s was not found" % (index, media_id))
+    file_path = _transcoder.get_cached_segment(item.id, index)
+    _transcoder.prefetch_segments(item.path, item.id, index + 1, length)
+    response.set_header('Content-Type', _transcoder.SEGMENT_TYPE)
+    if file_path is not None:
+        if _use_x_sendfile():
+            response.set_header('X-Sendfile', file_path)
+            return
+        return _serve_file(file_path)
+    job = _transcoder.start_segment_transcode(item.path, item.id, index)
+    response.set_header('Pragma', 'no-cache')
+    return job.stream(_transcoder.BUF_SIZE)
+
+
 @app.route('/transcode', method='POST')
 def start_background_transcode():
-    """Handle a request for a background transcode"""
+    """Handle a request for a background transcode. The items are
+    transcoded like prefetched items, with the profile accepted by the client.
+    """
     ids = request.forms.get('media_ids')
     if ids is not None:
-        for media_id in ids.split(','):
-            item = _get_item(media_id)
-            _transcoder.get_output_type(
-                item, request.get_header('accept').split(','), background=True
-            )
-            if not item.cached:
-                _transcoder.start_transcode(item.path, item.id, background=True)
+        items = [_get_item(media_id) for media_id in ids.split(',')]
+        _transcoder.prefetch_items(items, request.get_header('accept', default=''))
+
+
+@app.route('/transcode/status')
+def transcode_status():
+    """Show the running and queued transcodes"""
+    return _transcoder.scheduler.status()
+
+
+@app.route('/cache/status')
+def cache_status():
+    """Show the transcode cache size and hit counts"""
+    return _transcoder.cache.stats()
+
+
+@app.route('/art/item/<media_id>')
+def item_art(media_id):
+    """Redirects to the album art of the item, in the thumbnail size
+    given by the size query parameter. The art is extracted on the
+    first request for any item in the album.
+    """
+    item = _get_item(media_id)
+    art_hash = _transcoder.get_album_art(item.path, item.artist, item.album)
+    if art_hash is None:
+        raise HTTPError(404, "Item %s has no album art" % media_id)
+    url = '/art/' + art_hash
+    size = _art_size()
+    if size is not None:
+        url += '/%i' % size
+    # The art of an item can change, so the redirect is only briefly cached
+    response.set_header('Cache-Control', 'public, max-age=3600')
+    bottle.redirect(url)
+
+
+@app.route('/art/<art_hash:re:[0-9a-f]{40}>')
+@app.route('/art/<art_hash:re:[0-9a-f]{40}>/<size:int>')
+def album_art(art_hash, size=None):
+    """Sends the album art image, or its thumbnail. Images are named by
+    their content hash so never change, and are cached indefinitely.
+    """
+    file_path = _transcoder.art.get_path(art_hash, size)
+    if file_path is None:
+        raise HTTPError(404, "Album art %s was not found" % art_hash)
+    response.set_header('Content-Type', mimetypes.guess_type(file_path)[0] or 'image/jpeg')
+    response.set_header('Cache-Control', 'public, max-age=31536000, immutable')
+    if _use_x_sendfile():
+        response.set_header('X-Sendfile', file_path)
+        return
+    return _serve_file(file_path)
+
+
+def _art_size():
+    """Returns the smallest thumbnail size at least as large as the size
+    query parameter, or None for the full size image
+    """
+    try:
+        size = int(request.query.size) if request.query.size else None
+    except ValueError:
+        raise HTTPError(400, "Invalid size %s" % request.query.size)
+    if size is None:
+        return None
+    larger = [thumb for thumb in _transcoder.art.sizes if thumb >= size]
+    return min(larger) if larger else None
 
 
 def _create_media_symlink(item):
     """Creates a symlink to the media item in the cache directory
-    and returns the symlink path
+    and returns the symlink path. An existing link to the item, created
+    by a concurrent request, is used as is.
     """
     ext = os.path.splitext(item.path)[1]
     sym_path = os.path.join(config.CACHE_DIR, str(item.id) + ext)
-    os.symlink(item.path, sym_path)
-    _transcoder.add_cached_file(item.id, ext[1:], sym_path)
+    try:
+        os.symlink(item.path, sym_path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or os.readlink(sym_path) != item.path:
+            raise
+    _transcoder.add_cached_file(item.id, sym_path, ext[1:], verified=True)
     return sym_path
 
 
-def _set_stream_header(item, receive_type):
+def _set_stream_header(item, receive_type, use_cache=True, file_format=None):
     """Sets the headers for the media stream,
-    sets the X-Sendfile header if possible
+    sets the X-Sendfile header if possible.
+    The cached file is looked up in file_format, or the
+    cached format of receive_type if not given.
+    Returns the path of the cached file, or None if
+    the item must be transcoded.
     """
-    file_path = _transcoder.get_cached_file(item.id, receive_type.split('/')[1])
-    if receive_type == item.mime_type and file_path is None:
-        file_path = _create_media_symlink(item)
+    file_path = None
+    if use_cache:
+        original = file_format is None and receive_type == item.mime_type
+        if original:
+            # The original file is cached under its own extension
+            file_format = os.path.splitext(item.path)[1][1:]
+        elif file_format is None:
+            file_format = (_transcoder.get_cached_format(item.id, receive_type) or
+                           receive_type.split('/')[1])
+        file_path = _transcoder.get_cached_file(item.id, file_format, item.length)
+        if original and file_path is None:
+            file_path = _create_media_symlink(item)
     if file_path is not None:
         _logger.info('Retrieving item from cache')
         item.cached = True
-        # TODO - Use bottle static file with the development server
-        response.set_header('X-Sendfile', file_path)
+        if _use_x_sendfile():
+            response.set_header('X-Sendfile', file_path)
         response.set_header('Content-Type', receive_type)
-        return
+        return file_path
     response.set_header('Pragma', 'no-cache')
     response.set_header('Content-Type', receive_type)
-    # Set the accept ranges header to allow range requests once transcoding is complete
-    response.set_header('Accept-Ranges', 'bytes')
+    # Ranges of a wav stream map to times, so can be transcoded from that
+    # point. Other live streams cannot be seeked until they are cached.
+    if receive_type == _transcoder.MIME_MAP['wav']:
+        response.set_header('Accept-Ranges', 'bytes')
+    else:
+        response.set_header('Accept-Ranges', 'none')
     response.set_header('X-Content-Duration', str(item.length))
 
 
+def _use_x_sendfile():
+    """Returns True if files can be sent with mod_xsendfile, which
+    is enabled by the apache config when running under mod_wsgi
+    """
+    return 'mod_wsgi.version' in request.environ
+
+
+def _serve_file(file_path):
+    """Serves the file directly, handling conditional and
+    single range requests
+    """
+    stats = os.stat(file_path)
+    etag = '"%x-%x-%x"' % (stats.st_ino, stats.st_size, int(stats.st_mtime))
+    response.set_header('ETag', etag)
+    response.set_header('Last-Modified', email.utils.formatdate(stats.st_mtime, usegmt=True))
+    response.set_header('Accept-Ranges', 'bytes')
+
+    if_none_match = request.get_header('if-none-match')
+    if if_none_match is not None:
+        not_modified = if_none_match.strip() == '*' or etag in [
+            tag.strip() for tag in if_none_match.split(',')
+        ]
+    else:
+        since = bottle.parse_date(request.get_header('if-modified-since', default=''))
+        not_modified = since is not None and since >= int(stats.st_mtime)
+    if not_modified:
+        response.status = 304
+        return ''
+
+    request_range = request.get_header('range')
+    if_range = request.get_header('if-range')
+    if request_range is not None and (if_range is None or if_range == etag):
+        ranges = list(bottle.parse_range_header(request_range, stats.st_size))
+        if len(ranges) == 0:
+            response.status = 416
+            response.set_header('Content-Range', 'bytes */%i' % stats.st_size)
+            return "Requested range not satisfiable"
+        start, end = ranges[0]
+        response.status = 206
+        response.set_header('Content-Range', 'bytes %i-%i/%i' % (start, end - 1, stats.st_size))
+        response.set_header('Content-Length', str(end - start))
+        return _file_range_generator(file_path, start, end - start)
+
+    response.set_header('Content-Length', str(stats.st_size))
+    # Bottle passes file objects to wsgi.file_wrapper, allowing sendfile to be used
+    return open(file_path, 'rb')
+
+
+def _file_range_generator(file_path, offset, length):
+    """Generator yielding length bytes of the file from offset"""
+    with open(file_path, 'rb') as range_file:
+        range_file.seek(offset)
+        while length > 0:
+            buf = range_file.read(min(_transcoder.BUF_SIZE * 16, length))
+            if not buf:
+                break
+            length -= len(buf)
+            yield buf
+
+
 def _get_item(media_id):
     """Gets the item associated with the given id"""
-    with MediaLibrary() as library:
+    with _library() as library:
         item = library.get_item(media_id)
     if item is None:
-        raise HTTPError(code=404, output="Item %s was not found" % media_id)
+        raise HTTPError(404, "Item %s was not found" % media_id)
     return item
 
 
@@ -129,7 +570,9 @@ def _get_item(media_id):
 def show_player(media_id):
     """Show the player for the given media id"""
     item = _get_item(media_id)
-    return {'id': media_id, 'name': item.name}
+    # Ask for the client hints used to pick the live bitrate
+    response.set_header('Accept-CH', 'Downlink, Save-Data')
+    return {'id': media_id, 'name': item.name, 'stream_query': _order_query()}
 
 
 if __name__ == "__main__":
@@ -9,6 +9,10 @@ setup(
     package_data={'': ['*.tpl', '*.js', '*.png']},
     install_requires=['bottle>=0.12'],
     entry_points={
-        'console_scripts': ['pywebplayer-setup=pywebplayer.configure:main']
+        'console_scripts': [
+            'pywebplayer-setup=pywebplayer.configure:main',
+            'pywebplayer-watch=pywebplayer.discover:main',
+            'pywebplayer-warm=pywebplayer.warm:main'
+        ]
     }
 )